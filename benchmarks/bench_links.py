@@ -0,0 +1,91 @@
+"""
+مقارنة فحص الروابط القديم (تعبير نمطي على النص + بحث جزئي عن كل نمط) بـ LinkPolicy
+(روابط من كيانات الرسالة + فهرس لواحق النطاق)، مع عدد الرسائل التي يختلف فيها القرار.
+
+التشغيل:
+    python benchmarks/bench_links.py [عدد_الأنماط] [عدد_الرسائل]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("ADMIN_ID", "0")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/benchmark")
+
+from telegram import Message  # noqa: E402
+
+from bot import LinkPolicy, message_links  # noqa: E402
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+def random_label(rng: random.Random) -> str:
+    return "".join(rng.choice(LETTERS) for _ in range(rng.randint(4, 10)))
+
+def legacy_has_forbidden_link(allowed_links, message_text: str) -> bool:
+    """نسخة من الفحص القديم في group_message_handler."""
+    if re.search(r'https?://|t\.me/|www\.', message_text):
+        return not any(pattern in message_text for pattern in allowed_links)
+    return False
+
+def make_message(message_id: int, words) -> Message:
+    """رسالة بكيانات url كما يرسلها تيليجرام لكل كلمة تبدو رابطًا."""
+    text, entities = "", []
+    for word in words:
+        if text:
+            text += " "
+        if "." in word:
+            entities.append({"type": "url", "offset": len(text), "length": len(word)})
+        text += word
+    return Message.de_json(
+        {"message_id": message_id, "date": 0, "chat": {"id": -1, "type": "supergroup"}, "text": text, "entities": entities},
+        None,
+    )
+
+def bench(label: str, func, items):
+    started = time.perf_counter()
+    results = [func(item) for item in items]
+    elapsed = time.perf_counter() - started
+    print(f"{label:<10} {elapsed * 1000:9.1f} ms  ({len(items) / elapsed:,.0f} msg/s)")
+    return elapsed, results
+
+def main():
+    pattern_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    rng = random.Random(42)
+
+    domains = [f"{random_label(rng)}.{rng.choice(('com', 'net', 'org', 'io'))}" for _ in range(pattern_count)]
+    allowed_links = domains[: pattern_count - 1] + ["t.me/techtouch"]
+
+    messages = []
+    for i in range(message_count):
+        words = [random_label(rng) for _ in range(rng.randint(3, 15))]
+        kind = i % 5
+        if kind == 0:
+            words.append(f"https://{rng.choice(domains)}/watch?v={i}")
+        elif kind == 1:
+            words.append(f"https://{random_label(rng)}.com/x")
+        elif kind == 2:
+            # رابط خبيث يحتوي نطاقًا مسموحًا في الاستعلام أو كنطاق فرعي
+            words.append(rng.choice((f"https://evil.com/?u={rng.choice(domains)}", f"https://{rng.choice(domains)}.evil.com/")))
+        messages.append(make_message(i, words))
+    texts = [message.text.lower() for message in messages]
+
+    started = time.perf_counter()
+    policy = LinkPolicy(allowed_links)
+    print(f"{pattern_count} نمط، {message_count} رسالة. زمن بناء الفهرس: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    legacy_time, legacy = bench("legacy", lambda text: legacy_has_forbidden_link(allowed_links, text), texts)
+    policy_time, current = bench(
+        "policy", lambda message: not all(policy.is_allowed(link) for link in message_links(message)), messages
+    )
+    print(f"التسريع: {legacy_time / policy_time:.1f}x")
+
+    differences = sum(1 for a, b in zip(legacy, current) if a != b)
+    print(f"رسائل اختلف فيها القرار: {differences} (أغلبها روابط خبيثة كان الفحص القديم يسمح بها)")
+
+if __name__ == "__main__":
+    main()
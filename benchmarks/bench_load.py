@@ -0,0 +1,348 @@
+"""
+اختبار حمل دون اتصال: يشغّل معالجات bot.py الحقيقية (نفس تسجيل المعالجات ومعالج التحديثات المتزامن)
+على تدفق تحديثات مصطنع، مقابل واجهة تيليجرام وهمية داخل العملية وقاعدة بيانات وهمية في الذاكرة.
+
+السيناريوهات:
+    group      رسائل مجموعات فيها روابط وكلمات محظورة وردود تلقائية ورسائل عادية
+    flood      هجوم إغراق: عدد قليل من المرسلين يكررون روابط وكلمات محظورة بسرعة
+    private    رسائل خاصة من مستخدمين (رد تلقائي + تحويل للمشرف)
+    broadcast  بث رسالة إلى عدد من المستخدمين الوهميين
+
+لكل سيناريو: رسالة/ثانية، زمن p50/p99 لكل تحديث من تسليمه حتى انتهائه (يشمل الانتظار خلف حد التزامن
+لأن الرسائل تصل دفعة واحدة)، واستعلامات SQL وطلبات API لكل رسالة. زمن المعالج وحده يُطبع من مقاييس البوت.
+
+التشغيل:
+    python benchmarks/bench_load.py [عدد_الرسائل] [عدد_مستخدمي_البث] [تأخير_API_بالمللي_ثانية] [تأخير_القاعدة_بالمللي_ثانية]
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/benchmark")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("METRICS_PORT", "0")
+# نقيس سرعة الكود نفسه، لا حد تيليجرام الذي يفرضه TokenBucket
+os.environ.setdefault("BROADCAST_RATE", "1000000")
+os.environ.setdefault("BROADCAST_PROGRESS_INTERVAL", "3600")
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+ADMIN_ID = bot.ADMIN_ID
+BOT_USER = {"id": 999, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+ARABIC_LETTERS = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+BLOCKED_EVERY = 50 # كل مستخدم رقمه من مضاعفات هذا العدد "حظر البوت"
+
+# --- قاعدة بيانات وهمية ---
+
+class FakeStore:
+    """الجداول التي تقرأها المعالجات، مع عدّاد لكل نوع استعلام."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.queries = Counter()
+        self.users = []
+        self.allowed_links = []
+        self.banned_words = []
+        self.auto_replies = []
+        self.settings = {"forward_reply_message": "تم استلام رسالتك، سيتم الرد قريبًا."}
+
+class FakeCursor:
+    ROUTES = (
+        (re.compile(r"SELECT link_pattern FROM allowed_links"), lambda store, params: [(p,) for p in store.allowed_links]),
+        (re.compile(r"SELECT word, duration_minutes, warning_message FROM banned_words"), lambda store, params: list(store.banned_words)),
+        (re.compile(r"SELECT keyword, reply FROM auto_replies"), lambda store, params: list(store.auto_replies)),
+        (re.compile(r"SELECT user_id FROM blocked_users"), lambda store, params: []),
+        (re.compile(r"SELECT value FROM settings WHERE key = '(\w+)'"), None),
+        (re.compile(r"SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s"), None),
+    )
+
+    def __init__(self, store: FakeStore, connection):
+        self.store = store
+        self.connection = connection
+        self.rowcount = -1
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args):
+        return template.replace(b"%s", b"%r") % tuple(args)
+
+    def execute(self, query, params=None):
+        if isinstance(query, bytes):
+            query = query.decode()
+        query = " ".join(query.split())
+        if self.store.latency:
+            time.sleep(self.store.latency)
+        with self.store.lock:
+            self.store.queries[query.split(" ", 1)[0].upper()] += 1
+        self._rows, self.rowcount = [], 0
+        if query.startswith("INSERT INTO users"):
+            self.rowcount = len(re.findall(r"\((\d+)\)", query))
+            return
+        for pattern, route in self.ROUTES:
+            match = pattern.search(query)
+            if not match:
+                continue
+            if route is not None:
+                self._rows = route(self.store, params)
+            elif "settings" in pattern.pattern:
+                value = self.store.settings.get(match.group(1))
+                self._rows = [(value,)] if value is not None else []
+            else:
+                after, limit = params
+                self._rows = [(uid,) for uid in self.store.users if uid > after][:limit]
+            self.rowcount = len(self._rows)
+            return
+        if query.startswith(("UPDATE", "DELETE")):
+            self.rowcount = 1
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+class FakeConnection:
+    encoding = "UTF8"
+    closed = 0
+
+    def __init__(self, store: FakeStore):
+        self.store = store
+
+    def cursor(self):
+        return FakeCursor(self.store, self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class FakeConnectionPool:
+    def __init__(self, store: FakeStore):
+        self.store = store
+
+    def getconn(self):
+        return FakeConnection(self.store)
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+class FakeDatabasePool(bot.DatabasePool):
+    """نفس DatabasePool (الخيوط والحد الأقصى والمقاييس) لكن الاتصالات من FakeStore."""
+
+    def __init__(self, store: FakeStore):
+        super().__init__("fake://", 1, bot.DB_POOL_MAX_SIZE, bot.DB_HEALTH_CHECK_INTERVAL)
+        self.store = store
+
+    def open(self):
+        self._pool = FakeConnectionPool(self.store)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="db")
+
+# --- واجهة تيليجرام وهمية ---
+
+class FakeBotApi(bot.MeteredRequest):
+    """يرد على طلبات Bot API محليًا بعد تأخير ثابت، فتمر الطلبات بنفس مسار MeteredRequest والتحويل في المكتبة."""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = iter(range(1, 10 ** 12))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, text="ok"):
+        chat = {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "supergroup", "first_name": "u"}
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": text}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = params.get("chat_id", 0)
+        if api_method in ("sendMessage", "sendPhoto", "sendVideo", "forwardMessage", "copyMessage", "editMessageText"):
+            if int(chat_id) > 0 and int(chat_id) != ADMIN_ID and int(chat_id) % BLOCKED_EVERY == 0:
+                return 403, json.dumps({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}).encode()
+            result = {"message_id": next(self._message_ids)} if api_method == "copyMessage" else self._message(chat_id, params.get("text", "ok"))
+        elif api_method == "getMe":
+            result = BOT_USER
+        elif api_method == "getChatAdministrators":
+            result = [{"status": "creator", "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"}, "is_anonymous": False}]
+        elif api_method == "getChat":
+            result = {"id": int(chat_id), "type": "private", "first_name": f"user{chat_id}", "accent_color_id": 0, "max_reaction_count": 0}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# --- توليد التحديثات ---
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(ARABIC_LETTERS) for _ in range(rng.randint(3, 8)))
+
+def make_update(update_id: int, chat: dict, user_id: int, text: str, application: Application) -> Update:
+    entities = [{"type": "url", "offset": m.start(), "length": m.end() - m.start()} for m in re.finditer(r"https?://\S+", text)]
+    message = {
+        "message_id": update_id,
+        "date": int(datetime.now(timezone.utc).timestamp()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if entities:
+        message["entities"] = entities
+    return Update.de_json({"update_id": update_id, "message": message}, application.bot)
+
+def group_updates(count: int, store: FakeStore, application: Application, rng: random.Random):
+    chats = [{"id": -1000000000000 - i, "type": "supergroup", "title": f"group{i}"} for i in range(50)]
+    updates = []
+    for i in range(count):
+        words = [random_word(rng) for _ in range(rng.randint(3, 20))]
+        kind = i % 10
+        if kind == 0:
+            words.append(f"https://spam{i}.example.com/x")
+        elif kind == 1:
+            words.append(f"https://{rng.choice(store.allowed_links)}/watch?v={i}")
+        elif kind == 2:
+            words.insert(rng.randrange(len(words)), rng.choice(store.banned_words)[0])
+        elif kind == 3:
+            words.append(rng.choice(store.auto_replies)[0])
+        user_id = ADMIN_ID if kind == 9 else 10_000 + rng.randrange(count)
+        updates.append(make_update(i + 1, rng.choice(chats), user_id, " ".join(words), application))
+    return updates
+
+def flood_updates(count: int, store: FakeStore, application: Application, rng: random.Random):
+    chats = [{"id": -1000000000100 - i, "type": "supergroup", "title": f"flood{i}"} for i in range(5)]
+    spammers = [(30_000 + i, chats[i % len(chats)]) for i in range(20)]
+    updates = []
+    for i in range(count):
+        user_id, chat = rng.choice(spammers)
+        spam = rng.choice((f"https://spam.example.com/{i}", rng.choice(store.banned_words)[0], rng.choice(store.auto_replies)[0]))
+        updates.append(make_update(i + 1, chat, user_id, f"{random_word(rng)} {spam}", application))
+    return updates
+
+def private_updates(count: int, application: Application, rng: random.Random):
+    updates = []
+    for i in range(count):
+        user_id = 20_000 + rng.randrange(count)
+        chat = {"id": user_id, "type": "private", "first_name": f"user{user_id}"}
+        updates.append(make_update(i + 1, chat, user_id, " ".join(random_word(rng) for _ in range(5)), application))
+    return updates
+
+# --- القياس ---
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def report(name: str, messages: int, elapsed: float, latencies, store: FakeStore, queries_before: int, api: FakeBotApi, calls_before: int):
+    queries = sum(store.queries.values()) - queries_before
+    calls = sum(api.calls.values()) - calls_before
+    line = f"{name:<10} {messages:>7} رسالة  {messages / elapsed:>9,.0f} رسالة/ث"
+    if latencies:
+        line += f"  p50 {percentile(latencies, 0.5) * 1000:7.2f}ms  p99 {percentile(latencies, 0.99) * 1000:7.2f}ms"
+    line += f"  SQL/رسالة {queries / messages:5.2f}  API/رسالة {calls / messages:5.2f}"
+    print(line)
+
+async def run_updates(application: Application, updates):
+    processor = application.update_processor
+    latencies = []
+
+    async def one(update):
+        started = time.perf_counter()
+        await processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(update) for update in updates))
+    # الكتابة المؤجلة لتسجيل المستخدمين وإجراءات الإشراف المجمّعة جزء من كلفة الرسائل
+    await bot.user_registry.flush()
+    await bot.flood_guard.flush()
+    return time.perf_counter() - started, latencies
+
+async def main():
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    broadcast_users = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    api_latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    db_latency = (float(sys.argv[4]) if len(sys.argv) > 4 else 1) / 1000
+    logging.getLogger().setLevel(logging.CRITICAL)
+    rng = random.Random(42)
+
+    store = FakeStore(db_latency)
+    store.allowed_links = ["youtube.com", "youtu.be", "t.me/techtouch"]
+    store.banned_words = [(random_word(rng), rng.choice((0, 60)), "{user} تحذير") for _ in range(500)]
+    store.auto_replies = [(random_word(rng) + " " + random_word(rng), "رد تلقائي") for _ in range(500)]
+    store.users = list(range(100_000, 100_000 + broadcast_users))
+
+    bot.db = FakeDatabasePool(store)
+    bot.db.open()
+    api = FakeBotApi(api_latency)
+    application = Application.builder().token(bot.TELEGRAM_TOKEN).request(api).updater(None).concurrent_updates(bot.update_processor).build()
+    bot.register_handlers(application)
+
+    print(
+        f"تأخير API: {api_latency * 1000:.0f}ms، تأخير القاعدة: {db_latency * 1000:.0f}ms، "
+        f"تزامن التحديثات: {bot.UPDATE_CONCURRENCY}، اتصالات القاعدة: {bot.db.max_size}"
+    )
+    async with application:
+        await bot.rule_cache.load()
+        await bot.user_registry.start()
+        bot.flood_guard.start(application.bot)
+        try:
+            for name, updates in (
+                ("group", group_updates(message_count, store, application, rng)),
+                ("flood", flood_updates(message_count, store, application, rng)),
+                ("private", private_updates(message_count, application, rng)),
+            ):
+                queries_before, calls_before = sum(store.queries.values()), sum(api.calls.values())
+                elapsed, latencies = await run_updates(application, updates)
+                report(name, len(updates), elapsed, latencies, store, queries_before, api, calls_before)
+
+            queries_before, calls_before = sum(store.queries.values()), sum(api.calls.values())
+            job = bot.BroadcastJob(1, "رسالة بث تجريبية", None, None, None, 0, 0, 0)
+            started = time.perf_counter()
+            await job.run(application.bot)
+            elapsed = time.perf_counter() - started
+            report("broadcast", broadcast_users, elapsed, None, store, queries_before, api, calls_before)
+            print(f"           نجح {job.sent}، فشل {job.failed}")
+        finally:
+            await bot.flood_guard.stop()
+            await bot.user_registry.stop()
+            bot.db.close()
+
+    group_p50 = bot.handler_seconds.quantile(0.5, "group_message_handler")
+    group_p99 = bot.handler_seconds.quantile(0.99, "group_message_handler")
+    print(f"\nمن مقاييس البوت: group_message_handler p50 {bot._ms(group_p50)}، p99 {bot._ms(group_p99)}")
+    print(f"أكثر طلبات API: {dict(api.calls.most_common(6))}")
+    print(f"استعلامات SQL حسب النوع: {dict(store.queries)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+مقارنة سرعة محرك المطابقة المُجمّع بالحلقة القديمة على الكلمات المحظورة والردود التلقائية.
+
+التشغيل:
+    python benchmarks/bench_matcher.py [عدد_القواعد] [عدد_الرسائل]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("ADMIN_ID", "0")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/benchmark")
+
+from bot import RuleMatcher  # noqa: E402
+
+ARABIC_LETTERS = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(ARABIC_LETTERS) for _ in range(rng.randint(3, 8)))
+
+def legacy_match(banned_words, auto_replies, message_text: str):
+    """نسخة من الحلقة القديمة في group_message_handler."""
+    for word, duration, warning in banned_words:
+        if re.search(r'\b' + re.escape(word.lower()) + r'\b', message_text):
+            return (word, duration, warning), None
+    for keyword, reply in auto_replies:
+        if keyword.lower() in message_text:
+            return None, reply
+    return None, None
+
+def bench(label: str, func, messages) -> float:
+    started = time.perf_counter()
+    for text in messages:
+        func(text)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<10} {elapsed * 1000:9.1f} ms  ({len(messages) / elapsed:,.0f} msg/s)")
+    return elapsed
+
+def main():
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(42)
+
+    banned_words = [(random_word(rng), 60, "{user} تحذير") for _ in range(rule_count)]
+    auto_replies = [(random_word(rng) + " " + random_word(rng), "رد") for _ in range(rule_count)]
+    messages = []
+    for i in range(message_count):
+        words = [random_word(rng) for _ in range(rng.randint(5, 30))]
+        if i % 10 == 0:
+            words.insert(rng.randrange(len(words)), rng.choice(banned_words)[0])
+        messages.append(" ".join(words))
+
+    started = time.perf_counter()
+    matcher = RuleMatcher(banned_words, auto_replies)
+    print(f"{rule_count} قاعدة، {message_count} رسالة. زمن بناء المحرك: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    for text in messages[:200]:
+        old_banned, old_reply = legacy_match(banned_words, auto_replies, text)
+        new_banned, new_reply = matcher.match(text)
+        assert (old_banned is None) == (new_banned is None), text
+
+    legacy = bench("legacy", lambda text: legacy_match(banned_words, auto_replies, text), messages)
+    compiled = bench("compiled", matcher.match, messages)
+    print(f"التسريع: {legacy / compiled:.1f}x")
+
+if __name__ == "__main__":
+    main()
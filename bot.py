@@ -1,151 +1,2662 @@
 import os
+import json
 import logging
 import re
+import shutil
+import tempfile
 import asyncio
+import bisect
+import contextlib
+import csv
+import fcntl
+import functools
+import hashlib
+import hmac
+import io
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+PROCESS_STARTED = time.perf_counter()
 
 # استيراد مكتبة قاعدة البيانات PostgreSQL
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # استيراد المكتبات اللازمة من python-telegram-bot
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, InputFile, MessageEntity
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
 )
-from telegram.constants import ParseMode, ChatMemberStatus
-from telegram.error import BadRequest, Forbidden
+from telegram.constants import ParseMode, ChatMemberStatus, UpdateType
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+# مكتبة yt-dlp تُستورد عند أول تحميل فقط (load_yt_dlp) لتسريع بدء التشغيل
+
+# استيراد مكتبة تحميل متغيرات البيئة
+from dotenv import load_dotenv
+
+# --- الإعدادات الأولية ---
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+ADMIN_ID_STR = os.getenv("ADMIN_ID")
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not all([TELEGRAM_TOKEN, ADMIN_ID_STR, DATABASE_URL]):
+    logger.critical("خطأ فادح: أحد متغيرات البيئة (TELEGRAM_TOKEN, ADMIN_ID, DATABASE_URL) غير موجود.")
+    exit()
+
+ADMIN_ID = int(ADMIN_ID_STR)
+
+# --- المقاييس (بصيغة Prometheus) ---
+
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # معطلة افتراضيًا؛ مثلًا 9464 لتفعيل /metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self):
+        for label_values, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """توزيع بحدود ثابتة؛ العدّ يُخزّن لكل حد على حدة ويُجمّع عند العرض فقط."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        data = self._values.get(label_values)
+        if data is None:
+            data = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def count(self, *label_values) -> int:
+        if label_values:
+            data = self._values.get(label_values)
+            return data[2] if data else 0
+        return sum(data[2] for data in self._values.values())
+
+    def sum(self, *label_values) -> float:
+        if label_values:
+            data = self._values.get(label_values)
+            return data[1] if data else 0.0
+        return sum(data[1] for data in self._values.values())
+
+    def quantile(self, q: float, *label_values):
+        """تقدير تقريبي بالاستيفاء داخل الحد الذي يقع فيه الترتيب المطلوب، أو None بلا عينات."""
+        data = self._values.get(label_values)
+        if not data or not data[2]:
+            return None
+        rank = q * data[2]
+        seen = 0
+        for i, bucket_count in enumerate(data[0]):
+            if bucket_count and seen + bucket_count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render(self):
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labels + ('le',), label_values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {count}"
+
+class CallbackMetric:
+    """قيمة تُقرأ من مصدرها لحظة الطلب (مثل عمق الطابور أو عدّادات stats الموجودة)."""
+
+    def __init__(self, name: str, help_text: str, kind: str, func, label: str = None):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.func = func
+        self.label = label
+
+    def render(self):
+        value = self.func()
+        if self.label is None:
+            yield f"{self.name} {value}"
+            return
+        for key, item in sorted(value.items()):
+            yield f"{self.name}{_format_labels((self.label,), (key,))} {item}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._server = None
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str, func, label: str = None) -> CallbackMetric:
+        return self._register(CallbackMetric(name, help_text, kind, func, label))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"فشل حساب المقياس {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"المقاييس متاحة على http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram("bot_handler_duration_seconds", "زمن تنفيذ كل معالج تحديثات.", ("handler",))
+handler_errors = metrics.counter("bot_handler_errors_total", "الاستثناءات التي خرجت من المعالجات.", ("handler",))
+
+def timed_handler(func):
+    """يسجل زمن المعالج وأخطاءه في المقاييس باسم الدالة."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class StartupReport:
+    """زمن كل مرحلة من بدء التشغيل، وزمن أول تحديث تمت معالجته منذ بدء العملية."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = {}
+        self._last = started
+        self._first_update_seen = False
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round(now - self._last, 4)
+        self._last = now
+
+    def ready(self):
+        self.mark("post_init")
+        phases = "، ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases.items())
+        logger.info(f"جاهز لاستقبال التحديثات بعد {time.perf_counter() - self.started:.2f} ثانية ({phases}).")
+
+    def first_update(self):
+        if self._first_update_seen:
+            return
+        self._first_update_seen = True
+        self.phases["first_update_total"] = round(time.perf_counter() - self.started, 4)
+        logger.info(f"تمت معالجة أول تحديث بعد {self.phases['first_update_total']:.2f} ثانية من بدء العملية.")
+
+startup_report = StartupReport(PROCESS_STARTED)
+metrics.callback("bot_startup_seconds", "زمن مراحل بدء التشغيل.", "gauge", lambda: startup_report.phases, "phase")
+
+# --- إدارة قاعدة بيانات PostgreSQL ---
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+db_query_seconds = metrics.histogram("bot_db_query_duration_seconds", "زمن تنفيذ كل عملية على قاعدة البيانات (بدون انتظار المجمع).", ("op",))
+db_query_errors = metrics.counter("bot_db_query_errors_total", "العمليات التي فشلت بخطأ من قاعدة البيانات.", ("op",))
+
+class DatabasePool:
+    """
+    مجمع اتصالات مشترك بين كل المعالجات.
+    الاستعلامات تُنفذ في خيوط منفصلة حتى لا تُوقف حلقة الأحداث.
+    """
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, health_check_interval: float):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._pool = None
+        self._executor = None
+        self._slots = asyncio.Semaphore(max_size)
+        self._last_used = {}
+        self.stats = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "health_check_failures": 0,
+            "errors": 0,
+        }
+
+    def open(self):
+        self._pool = ThreadedConnectionPool(self.min_size, self.max_size, self.dsn)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_size, thread_name_prefix="db")
+        logger.info(f"تم فتح مجمع الاتصالات (الحد الأدنى {self.min_size}، الحد الأقصى {self.max_size}).")
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._pool:
+            self._pool.closeall()
+            self._pool = None
+        logger.info(f"تم إغلاق مجمع الاتصالات. الإحصائيات: {self.stats}")
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        last_used = self._last_used.get(id(conn))
+        idle_too_long = last_used is not None and time.monotonic() - last_used > self.health_check_interval
+        if conn.closed or (idle_too_long and not self._is_healthy(conn)):
+            self.stats["health_check_failures"] += 1
+            logger.warning("اتصال غير صالح في المجمع، سيتم استبداله.")
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    def run_sync(self, func, *args):
+        """ينفذ func(cur, *args) داخل معاملة واحدة ويعيد نتيجتها."""
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                result = func(cur, *args)
+            conn.commit()
+            return result
+        except psycopg2.Error:
+            self.stats["errors"] += 1
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            self._last_used[id(conn)] = time.monotonic()
+            if broken:
+                self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=broken)
+
+    async def run(self, func, *args):
+        started = time.monotonic()
+        if self._slots.locked():
+            self.stats["waited"] += 1
+        async with self._slots:
+            waited = time.monotonic() - started
+            self.stats["acquired"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+            op = func.__name__.lstrip("_")
+            loop = asyncio.get_running_loop()
+            try:
+                with db_query_seconds.time(op):
+                    return await loop.run_in_executor(self._executor, functools.partial(self.run_sync, func, *args))
+            except psycopg2.Error:
+                db_query_errors.inc(op)
+                raise
+
+    async def execute(self, query: str, params=None) -> int:
+        def _execute(cur):
+            cur.execute(query, params)
+            return cur.rowcount
+        return await self.run(_execute)
+
+    async def fetchone(self, query: str, params=None):
+        def _fetchone(cur):
+            cur.execute(query, params)
+            return cur.fetchone()
+        return await self.run(_fetchone)
+
+    async def fetchall(self, query: str, params=None):
+        def _fetchall(cur):
+            cur.execute(query, params)
+            return cur.fetchall()
+        return await self.run(_fetchall)
+
+db = DatabasePool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_HEALTH_CHECK_INTERVAL)
+metrics.callback(
+    "bot_db_pool_total", "عدّادات مجمع الاتصالات (db.stats).", "counter",
+    lambda: {key: value for key, value in db.stats.items() if key != "wait_seconds_max"}, "stat",
+)
+metrics.callback("bot_db_pool_wait_seconds_max", "أطول انتظار لاتصال من المجمع منذ بدء التشغيل.", "gauge", lambda: db.stats["wait_seconds_max"])
+
+# كل ترحيل يُطبق مرة واحدة ويُسجل في schema_migrations. الأوامر تبقى IF NOT EXISTS
+# لأن قواعد البيانات القديمة أنشأت هذه الجداول قبل وجود الترحيلات.
+MIGRATIONS = (
+    (1, "الجداول الأساسية", (
+        "CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY);",
+        "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS auto_replies (keyword TEXT PRIMARY KEY, reply TEXT NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS banned_words (word TEXT PRIMARY KEY, duration_minutes INTEGER NOT NULL, warning_message TEXT);",
+        "CREATE TABLE IF NOT EXISTS allowed_links (link_pattern TEXT PRIMARY KEY);",
+        """
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id BIGINT PRIMARY KEY, 
+                full_name TEXT,
+                username TEXT,
+                blocked_date TIMESTAMPTZ DEFAULT NOW()
+            );
+        """,
+        "INSERT INTO settings (key, value) VALUES ('welcome_message', 'أهلاً بك في البوت!') ON CONFLICT (key) DO NOTHING;",
+        "INSERT INTO settings (key, value) VALUES ('forward_reply_message', 'شكرًا لرسالتك، تم توصيلها للدعم وسنرد عليك قريبًا.') ON CONFLICT (key) DO NOTHING;",
+    )),
+    (2, "مهام البث", (
+        """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id SERIAL PRIMARY KEY,
+                text TEXT,
+                entities JSONB,
+                photo TEXT,
+                video TEXT,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id BIGINT NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            );
+        """,
+        "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner TEXT;",
+        "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;",
+    )),
+    (3, "الحالة المشتركة", (
+        """
+            CREATE TABLE IF NOT EXISTS bot_state (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value JSONB NOT NULL,
+                updated_at TIMESTAMPTZ DEFAULT NOW(),
+                PRIMARY KEY (scope, key)
+            );
+        """,
+    )),
+    (4, "ذاكرة الوسائط", (
+        """
+            CREATE TABLE IF NOT EXISTS media_cache (
+                cache_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                title TEXT,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                last_used_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        """,
+        "CREATE INDEX IF NOT EXISTS media_cache_last_used_idx ON media_cache (last_used_at);",
+    )),
+    (5, "فهرس قائمة المحظورين", (
+        "CREATE INDEX IF NOT EXISTS blocked_users_date_idx ON blocked_users (blocked_date DESC, user_id DESC);",
+    )),
+)
+MIGRATIONS_LOCK_ID = 7210421 # قفل استشاري حتى لا تطبق نسختان الترحيلات معًا
+
+def _schema_version(cur) -> int:
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+    return cur.fetchone()[0]
+
+def _apply_migrations(cur) -> list:
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMPTZ DEFAULT NOW()
+        );
+    """)
+    # نسخة أخرى ربما طبقتها أثناء انتظار القفل
+    current = _schema_version(cur)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        for statement in statements:
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);", (version, description))
+        applied.append(version)
+    return applied
+
+def setup_database():
+    """يطبق الترحيلات الناقصة فقط؛ عند تحديث القاعدة يكلف استعلامًا واحدًا دون أوامر DDL."""
+    latest = MIGRATIONS[-1][0]
+    try:
+        if db.run_sync(_schema_version) >= latest:
+            logger.info(f"قاعدة البيانات محدثة (الإصدار {latest}).")
+            return
+        applied = db.run_sync(_apply_migrations)
+        logger.info(f"تم تطبيق الترحيلات {applied}، إصدار قاعدة البيانات الآن {latest}.")
+    except psycopg2.Error as e:
+        logger.error(f"لا يمكن تهيئة قاعدة البيانات: {e}")
+
+# --- الحالة المشتركة بين نسخ البوت ---
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "postgres")
+STATE_EVENTS_CHANNEL = os.getenv("STATE_EVENTS_CHANNEL", "bot_events")
+STATE_LISTEN_RETRY_SECONDS = float(os.getenv("STATE_LISTEN_RETRY_SECONDS", "5"))
+STATE_LISTEN_CONNECT_TIMEOUT = int(os.getenv("STATE_LISTEN_CONNECT_TIMEOUT", "10"))
+BROADCAST_LEASE_SECONDS = float(os.getenv("BROADCAST_LEASE_SECONDS", "60"))
+INSTANCE_ID = uuid.uuid4().hex
+
+class StateBackend:
+    """
+    الواجهة المشتركة لحالة محادثة المشرف، وملكية مهام البث، وأحداث إبطال الذاكرة المؤقتة.
+    الأحداث التي ترسلها النسخة نفسها لا تُعاد إليها، فالمرسل يطبّق التغيير محليًا قبل الإرسال.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, event: str, callback):
+        self._subscribers.setdefault(event, []).append(callback)
+
+    def _dispatch(self, event: str, data=None):
+        for callback in self._subscribers.get(event, ()):
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(f"خطأ في معالجة الحدث {event}: {e}")
+
+class MemoryStateBackend(StateBackend):
+    """حالة داخل العملية فقط، لتشغيل نسخة واحدة أو للاختبارات."""
+
+    # الحجز في الذاكرة فقط، فعمود owner في broadcast_jobs يبقى فارغًا
+    broadcast_owner = None
+
+    def __init__(self):
+        super().__init__()
+        self._conversations = {}
+        self._leases = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def load_conversation(self, user_id: int) -> dict:
+        return dict(self._conversations.get(user_id, {}))
+
+    async def save_conversation(self, user_id: int, state: dict):
+        if state:
+            self._conversations[user_id] = dict(state)
+        else:
+            self._conversations.pop(user_id, None)
+
+    async def claim_broadcast(self, job_id: int) -> bool:
+        self._leases[job_id] = time.monotonic() + BROADCAST_LEASE_SECONDS
+        return True
+
+    async def release_broadcast(self, job_id: int):
+        self._leases.pop(job_id, None)
+
+    async def publish(self, event: str, data=None):
+        pass
+
+class PostgresStateBackend(StateBackend):
+    """
+    حالة مشتركة في PostgreSQL (نفس DATABASE_URL) حتى تعمل عدة نسخ خلف webhook واحد:
+    حالة المحادثة في جدول bot_state، وملكية البث بعقد إيجار مؤقت في broadcast_jobs،
+    والأحداث عبر NOTIFY على STATE_EVENTS_CHANNEL مع اتصال LISTEN مسجل في حلقة الأحداث.
+    فتح اتصال LISTEN وإعادة فتحه يتمان في خيط منفصل بمهلة اتصال، فانقطاع القاعدة لا يوقف الحلقة.
+    """
+
+    broadcast_owner = INSTANCE_ID
+
+    def __init__(self, channel: str):
+        super().__init__()
+        self.channel = channel
+        self._listen_conn = None
+        self._reconnect_task = None
+        self._stopped = False
+
+    async def start(self):
+        self._stopped = False
+        await self._listen()
+
+    async def stop(self):
+        self._stopped = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            await asyncio.gather(self._reconnect_task, return_exceptions=True)
+            self._reconnect_task = None
+        self._unlisten()
+
+    async def load_conversation(self, user_id: int) -> dict:
+        row = await db.fetchone("SELECT value FROM bot_state WHERE scope = 'conversation' AND key = %s;", (str(user_id),))
+        return row[0] if row else {}
+
+    async def save_conversation(self, user_id: int, state: dict):
+        if state:
+            await db.execute("""
+                INSERT INTO bot_state (scope, key, value) VALUES ('conversation', %s, %s)
+                ON CONFLICT (scope, key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW();
+            """, (str(user_id), json.dumps(state)))
+        else:
+            await db.execute("DELETE FROM bot_state WHERE scope = 'conversation' AND key = %s;", (str(user_id),))
+
+    async def claim_broadcast(self, job_id: int) -> bool:
+        """يحجز البث لهذه النسخة أو يجدد حجزها، ويفشل إذا كانت نسخة أخرى تملكه بعقد ساري."""
+        row = await db.fetchone("""
+            UPDATE broadcast_jobs SET owner = %s, lease_until = NOW() + make_interval(secs => %s)
+            WHERE job_id = %s AND status = 'running'
+              AND (owner IS NULL OR owner = %s OR lease_until < NOW())
+            RETURNING job_id;
+        """, (INSTANCE_ID, BROADCAST_LEASE_SECONDS, job_id, INSTANCE_ID))
+        return row is not None
+
+    async def release_broadcast(self, job_id: int):
+        await db.execute(
+            "UPDATE broadcast_jobs SET owner = NULL, lease_until = NULL WHERE job_id = %s AND owner = %s;",
+            (job_id, INSTANCE_ID),
+        )
+
+    async def publish(self, event: str, data=None):
+        payload = json.dumps({"origin": INSTANCE_ID, "event": event, "data": data})
+        try:
+            await db.execute("SELECT pg_notify(%s, %s);", (self.channel, payload))
+        except psycopg2.Error as e:
+            logger.error(f"فشل إرسال الحدث {event}: {e}")
+
+    def _connect(self):
+        conn = psycopg2.connect(db.dsn, connect_timeout=STATE_LISTEN_CONNECT_TIMEOUT)
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("LISTEN {};").format(sql.Identifier(self.channel)))
+        except psycopg2.Error:
+            conn.close()
+            raise
+        return conn
+
+    async def _listen(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            conn = await loop.run_in_executor(None, self._connect)
+        except psycopg2.Error as e:
+            logger.error(f"فشل الاشتراك في أحداث الحالة المشتركة: {e}")
+            self._schedule_reconnect()
+            return False
+        if self._stopped:
+            conn.close()
+            return False
+        self._listen_conn = conn
+        loop.add_reader(conn.fileno(), self._on_notify)
+        return True
+
+    def _unlisten(self):
+        if self._listen_conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._listen_conn.fileno())
+        except (RuntimeError, ValueError):
+            pass
+        self._listen_conn.close()
+        self._listen_conn = None
+
+    def _schedule_reconnect(self):
+        if not self._stopped:
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        await asyncio.sleep(STATE_LISTEN_RETRY_SECONDS)
+        if await self._listen():
+            self._dispatch("resync")
+
+    def _on_notify(self):
+        try:
+            self._listen_conn.poll()
+        except psycopg2.Error as e:
+            logger.error(f"انقطع اتصال أحداث الحالة المشتركة: {e}")
+            self._unlisten()
+            self._schedule_reconnect()
+            return
+        notifies = list(self._listen_conn.notifies)
+        self._listen_conn.notifies.clear()
+        for notify in notifies:
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                continue
+            if payload.get("origin") != INSTANCE_ID:
+                self._dispatch(payload.get("event"), payload.get("data"))
+
+state_backend = PostgresStateBackend(STATE_EVENTS_CHANNEL) if STATE_BACKEND == "postgres" else MemoryStateBackend()
+
+# --- ذاكرة مؤقتة لقواعد الإشراف ---
+
+ARABIC_MARKS_RE = re.compile(r'[\u0640\u064B-\u065F\u0670\u06D6-\u06ED]')
+# الكلمات الأطول تُضاف كبدائل نصية مستقلة خارج الشجرة، حتى يبقى عمق التعبير النمطي محدودًا
+TRIE_MAX_WORD_LENGTH = 100
+
+def normalize_text(text: str) -> str:
+    """توحيد النص للمطابقة: أحرف صغيرة وحذف التشكيل والتطويل."""
+    return ARABIC_MARKS_RE.sub('', text.lower())
+
+def build_trie_pattern(words) -> str:
+    """
+    يبني تعبيرًا نمطيًا على شكل شجرة بادئات حتى لا تُجرّب كل كلمة على حدة عند كل موضع.
+    البناء بمكدس صريح لا بالاستدعاء الذاتي، والكلمات الأطول من TRIE_MAX_WORD_LENGTH بدائل نصية قبل الشجرة.
+    """
+    trie = {}
+    long_words = []
+    for word in words:
+        if len(word) > TRIE_MAX_WORD_LENGTH:
+            long_words.append(word)
+            continue
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    # ترتيب لاحق: كل عقدة تُبنى بعد أبنائها
+    built = {}
+    stack = [(trie, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for ch, child in node.items() if ch)
+            continue
+        branches = [re.escape(ch) + built.pop(id(child)) for ch, child in sorted(node.items()) if ch]
+        body = ''
+        if branches:
+            body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            if '' in node:
+                body = '(?:' + body + ')?'
+        built[id(node)] = body
+
+    alternatives = [re.escape(word) for word in sorted(long_words, key=len, reverse=True)]
+    if trie:
+        alternatives.append(built[id(trie)])
+    return alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+
+def compile_rules(rules: dict, kind: str, wrap=lambda pattern: pattern):
+    """
+    يجمّع القواعد في تعبير واحد. إن فشل التجميع تُجرّب كل قاعدة وحدها،
+    فتُسجّل القاعدة المعطوبة وتُحذف من rules بدل أن يفشل بناء القواعد كلها.
+    """
+    if not rules:
+        return None
+    try:
+        return re.compile(wrap(build_trie_pattern(rules)))
+    except (re.error, RecursionError, OverflowError):
+        pass
+    for word in list(rules):
+        try:
+            re.compile(wrap(build_trie_pattern([word])))
+        except (re.error, RecursionError, OverflowError) as e:
+            logger.error(f"تم تجاهل {kind} لا يمكن تجميعها ({word[:30]}...): {e}")
+            del rules[word]
+    return re.compile(wrap(build_trie_pattern(rules))) if rules else None
+
+class RuleMatcher:
+    """
+    محرك مطابقة مُجمّع مسبقًا لكل إصدار من القواعد.
+    الكلمات المحظورة تُطابق ككلمات كاملة، والردود التلقائية كنص جزئي (كما في السابق).
+    """
+
+    def __init__(self, banned_words, auto_replies):
+        self._banned = {}
+        for word, duration, warning in banned_words:
+            key = normalize_text(word)
+            if key:
+                self._banned.setdefault(key, (word, duration, warning))
+        self._replies = {}
+        for keyword, reply in auto_replies:
+            key = normalize_text(keyword)
+            if key:
+                self._replies.setdefault(key, reply)
+        self._banned_re = compile_rules(self._banned, "كلمة محظورة", lambda pattern: r'(?<!\w)' + pattern + r'(?!\w)')
+        self._replies_re = compile_rules(self._replies, "كلمة رد تلقائي")
+
+    def find_banned(self, normalized_text: str):
+        """يعيد (word, duration, warning) لأول كلمة محظورة في النص أو None."""
+        if self._banned_re is None:
+            return None
+        match = self._banned_re.search(normalized_text)
+        return self._banned[match.group(0)] if match else None
+
+    def find_reply(self, normalized_text: str):
+        if self._replies_re is None:
+            return None
+        match = self._replies_re.search(normalized_text)
+        return self._replies[match.group(0)] if match else None
+
+    def match(self, text: str, check_banned: bool = True):
+        """يطبّع النص مرة واحدة ويعيد (أول كلمة محظورة، أول رد تلقائي)."""
+        normalized = normalize_text(text)
+        banned = self.find_banned(normalized) if check_banned else None
+        return banned, self.find_reply(normalized)
+
+LINK_ENTITY_TYPES = (MessageEntity.URL, MessageEntity.TEXT_LINK)
+
+def normalize_host(host: str) -> str:
+    host = host.lower().rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    if not host.isascii():
+        try:
+            host = host.encode("idna").decode("ascii")
+        except UnicodeError:
+            pass
+    return host
+
+def split_tg_link(link: str):
+    """
+    يحوّل روابط tg: إلى ما يقابلها على t.me حتى تُفحص بالفهرس نفسه:
+    tg://resolve?domain=X ← t.me/X و tg://join?invite=Y ← t.me/+Y، وأي رابط tg: آخر ← t.me بلا مسار.
+    """
+    try:
+        parts = urlsplit(link)
+    except ValueError:
+        return "", ""
+    action = (parts.netloc or parts.path.strip("/")).lower()
+    params = dict(parse_qsl(parts.query))
+    if action == "resolve" and params.get("domain"):
+        return "t.me", "/" + params["domain"].lower()
+    if action == "join" and params.get("invite"):
+        return "t.me", "/+" + params["invite"].lower()
+    return "t.me", ""
+
+def split_link(link: str):
+    """
+    يعيد (المضيف الموحّد، المسار بأحرف صغيرة)، أو (None, '') لروابط mailto: فقط.
+    روابط tg: تُفحص كروابط t.me المقابلة، وأي مخطط آخر له مضيف (ftp:// وغيره) يُفحص كرابط ويب.
+    المضيف الفارغ يعني رابطًا غير صالح أو مموّهًا:
+    اسم مستخدم في الرابط أو شرطة مائلة عكسية (evil.com\\@youtube.com يفتحه المتصفح على evil.com).
+    """
+    if link.lower().startswith("mailto:"):
+        return None, ""
+    if link.lower().startswith("tg:"):
+        return split_tg_link(link)
+    if "://" not in link:
+        link = "http://" + link
+    try:
+        parts = urlsplit(link)
+        hostname = parts.hostname
+    except ValueError:
+        return "", ""
+    if "@" in parts.netloc or "\\" in parts.netloc:
+        return "", ""
+    return normalize_host(hostname or ""), parts.path.rstrip("/").lower()
+
+def message_links(message) -> list:
+    """الروابط التي حددها تيليجرام نفسه في نص الرسالة أو تعليقها (url و text_link)."""
+    if message.text:
+        entities = message.parse_entities(LINK_ENTITY_TYPES)
+    else:
+        entities = message.parse_caption_entities(LINK_ENTITY_TYPES)
+    return [entity.url if entity.type == MessageEntity.TEXT_LINK else text for entity, text in entities.items()]
+
+class LinkPolicy:
+    """
+    الروابط المسموحة مفهرسة حسب النطاق: "youtube.com" يسمح بالنطاق ونطاقاته الفرعية،
+    و"t.me/techtouch" يقيّد المسار أيضًا. الفحص يمر على لواحق اسم المضيف في جدول تجزئة،
+    فالكلفة بطول المضيف لا بعدد الأنماط، ولا يمر رابط مثل evil.com/?youtube.com.
+    الأنماط التي ليست نطاقًا (بلا نقطة) تبقى مطابقة كنص جزئي كما في السابق.
+    """
+
+    def __init__(self, allowed_links):
+        self._domains = {}
+        self._keywords = []
+        for pattern in allowed_links:
+            pattern = pattern.strip()
+            host, path = split_link(pattern)
+            if host and "." in host:
+                self._domains.setdefault(host, []).append(path)
+            elif pattern:
+                self._keywords.append(pattern.lower())
+
+    @staticmethod
+    def _path_allowed(path: str, prefixes) -> bool:
+        return any(not prefix or path == prefix or path.startswith(prefix + "/") for prefix in prefixes)
+
+    def is_allowed(self, link: str) -> bool:
+        host, path = split_link(link)
+        if host is None:
+            return True
+        if not host:
+            return False
+        candidate = host
+        while candidate:
+            prefixes = self._domains.get(candidate)
+            if prefixes and self._path_allowed(path, prefixes):
+                return True
+            candidate = candidate.partition(".")[2]
+        lowered = link.lower()
+        return any(keyword in lowered for keyword in self._keywords)
+
+class RuleSnapshot:
+    """نسخة ثابتة من قواعد الإشراف، تُستبدل بالكامل عند أي تعديل."""
+
+    def __init__(self, version: int, allowed_links, banned_words, auto_replies):
+        self.version = version
+        self.allowed_links = tuple(allowed_links)
+        self.banned_words = tuple(banned_words)
+        self.auto_replies = tuple(auto_replies)
+        self.matcher = RuleMatcher(self.banned_words, self.auto_replies)
+        self.link_policy = LinkPolicy(self.allowed_links)
+
+class RuleCache:
+    """
+    يحمّل الروابط المسموحة والكلمات المحظورة والردود التلقائية مرة واحدة،
+    ويعيد بناءها عند تعديلها من لوحة المشرف أو عند إشعار من نسخة أخرى.
+    """
+
+    def __init__(self):
+        self.snapshot = RuleSnapshot(0, (), (), ())
+        self._reload_lock = asyncio.Lock()
+
+    @staticmethod
+    def _fetch_rules(cur):
+        cur.execute("SELECT link_pattern FROM allowed_links;")
+        allowed_links = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT word, duration_minutes, warning_message FROM banned_words;")
+        banned_words = cur.fetchall()
+        cur.execute("SELECT keyword, reply FROM auto_replies;")
+        auto_replies = cur.fetchall()
+        return allowed_links, banned_words, auto_replies
+
+    async def load(self):
+        async with self._reload_lock:
+            allowed_links, banned_words, auto_replies = await db.run(self._fetch_rules)
+            self.snapshot = RuleSnapshot(self.snapshot.version + 1, allowed_links, banned_words, auto_replies)
+        logger.info(
+            f"تم تحميل قواعد الإشراف (الإصدار {self.snapshot.version}): "
+            f"{len(allowed_links)} رابط، {len(banned_words)} كلمة محظورة، {len(auto_replies)} رد تلقائي."
+        )
+
+    async def invalidate(self):
+        """يعيد البناء محليًا ثم يُبلغ باقي النسخ."""
+        await self.load()
+        await state_backend.publish("rules_changed")
+
+    def subscribe(self):
+        reload = lambda data: asyncio.get_running_loop().create_task(self.load())
+        state_backend.subscribe("rules_changed", reload)
+        # قد تكون فاتتنا إشعارات أثناء انقطاع الاتصال
+        state_backend.subscribe("resync", reload)
+
+rule_cache = RuleCache()
+
+# --- تسجيل المستخدمين (كتابة مؤجلة على دفعات) ---
+
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL_MS", "500")) / 1000
+USER_FLUSH_MAX_ROWS = int(os.getenv("USER_FLUSH_MAX_ROWS", "500"))
+KNOWN_USERS_MAX = int(os.getenv("KNOWN_USERS_MAX", "1000000"))
+
+class UserRegistry:
+    """
+    يتذكر المستخدمين المسجلين في الذاكرة حتى لا تُكتب كل رسالة في قاعدة البيانات.
+    المستخدمون الجدد وإلغاءات الحظر تُجمع وتُكتب دفعة واحدة كل USER_FLUSH_INTERVAL
+    أو عند تجاوز USER_FLUSH_MAX_ROWS، وتُفرّغ عند إيقاف البوت.
+    """
+
+    def __init__(self, flush_interval: float, flush_max_rows: int, known_max: int):
+        self.flush_interval = flush_interval
+        self.flush_max_rows = flush_max_rows
+        self.known_max = known_max
+        self._known = set()
+        self._blocked = set()
+        self._new = set()
+        self._unblock = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.blocked_version = 0
+        self.stats = {"skipped": 0, "buffered": 0, "flushes": 0, "rows_written": 0, "errors": 0}
+
+    async def start(self):
+        rows = await db.fetchall("SELECT user_id FROM blocked_users;")
+        self._blocked = {row[0] for row in rows}
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def register(self, user_id: int, unblock: bool = False):
+        queued = False
+        if user_id not in self._known and user_id not in self._new:
+            self._new.add(user_id)
+            queued = True
+        if unblock and user_id in self._blocked:
+            self._blocked.discard(user_id)
+            self._unblock.add(user_id)
+            self.blocked_version += 1
+            queued = True
+        if not queued:
+            self.stats["skipped"] += 1
+            return
+        self.stats["buffered"] += 1
+        if len(self._new) + len(self._unblock) >= self.flush_max_rows:
+            self._wakeup.set()
+
+    def subscribe(self):
+        state_backend.subscribe("users_blocked", lambda user_ids: self.mark_blocked(user_ids or ()))
+        state_backend.subscribe("users_replaced", lambda _: self.forget_known())
+        state_backend.subscribe("blocked_replaced", lambda _: asyncio.get_running_loop().create_task(self.reload_blocked()))
+
+    def forget_known(self):
+        """بعد استبدال جدول users: المستخدمون المحذوفون يُسجلون من جديد عند رسالتهم التالية."""
+        self._known.clear()
+
+    async def reload_blocked(self):
+        """بعد استبدال جدول blocked_users: يعيد قراءة قائمة المحظورين بدل الاعتماد على ما في الذاكرة."""
+        try:
+            rows = await db.fetchall("SELECT user_id FROM blocked_users;")
+        except psycopg2.Error as e:
+            logger.error(f"فشل إعادة تحميل قائمة المحظورين: {e}")
+            return
+        self._blocked = {row[0] for row in rows} - self._unblock
+        self.blocked_version += 1
+
+    def mark_blocked(self, user_ids):
+        """يُستدعى بعد أن ينقل البث (في هذه النسخة أو غيرها) المستخدمين إلى blocked_users ويحذفهم من users."""
+        for user_id in user_ids:
+            self._known.discard(user_id)
+            self._unblock.discard(user_id)
+            self._blocked.add(user_id)
+        self.blocked_version += 1
+
+    @staticmethod
+    def _write(cur, new_users, unblocked):
+        if new_users:
+            execute_values(cur, "INSERT INTO users (user_id) VALUES %s ON CONFLICT (user_id) DO NOTHING;", [(uid,) for uid in new_users])
+        if unblocked:
+            cur.execute("DELETE FROM blocked_users WHERE user_id = ANY(%s);", (unblocked,))
+
+    async def flush(self):
+        async with self._flush_lock:
+            new_users, unblocked = self._new, self._unblock
+            if not new_users and not unblocked:
+                return
+            self._new, self._unblock = set(), set()
+            try:
+                await db.run(self._write, list(new_users), list(unblocked))
+            except psycopg2.Error as e:
+                self.stats["errors"] += 1
+                logger.error(f"فشل تسجيل دفعة المستخدمين، ستُعاد المحاولة: {e}")
+                self._new |= new_users
+                self._unblock |= unblocked
+                return
+            if len(self._known) + len(new_users) > self.known_max:
+                self._known.clear()
+            self._known |= new_users
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(new_users) + len(unblocked)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+user_registry = UserRegistry(USER_FLUSH_INTERVAL, USER_FLUSH_MAX_ROWS, KNOWN_USERS_MAX)
+
+# --- دوال مساعدة ---
+
+def escape_markdown(text: str) -> str:
+    """تهريب الأحرف الخاصة في MarkdownV2."""
+    if not text:
+        return ""
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+
+def _ms(seconds) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+def metrics_summary() -> str:
+    """ملخص مختصر من المقاييس الحالية يُعرض في لوحة المشرف."""
+    group_p50 = handler_seconds.quantile(0.5, "group_message_handler")
+    group_p99 = handler_seconds.quantile(0.99, "group_message_handler")
+    db_count = db_query_seconds.count()
+    db_avg = db_query_seconds.sum() / db_count if db_count else None
+    return (
+        f"📈 الأداء منذ التشغيل:\n"
+        f"• رسائل المجموعات: {handler_seconds.count('group_message_handler')} (p50 {_ms(group_p50)}، p99 {_ms(group_p99)})\n"
+        f"• استعلامات القاعدة: {db_count} (متوسط {_ms(db_avg)}، أخطاء {db_query_errors.total():.0f})\n"
+        f"• طلبات تيليجرام: {telegram_request_seconds.count()} (أخطاء {telegram_errors.total():.0f}، RetryAfter {telegram_retry_after.total():.0f})\n"
+        f"• التحميلات: في الطابور {download_manager.queue_depth()}، قيد التنفيذ {download_manager.active_count()}\n"
+        f"• البث: أُرسل {broadcast_messages.get('sent'):.0f}، فشل {broadcast_messages.get('failed') + broadcast_messages.get('blocked'):.0f}"
+    )
+
+async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        [InlineKeyboardButton("📢 بث رسالة للجميع", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("📝 إدارة الردود التلقائية", callback_data="admin_manage_replies")],
+        [InlineKeyboardButton("🚫 إدارة الكلمات المحظورة", callback_data="admin_manage_banned")],
+        [InlineKeyboardButton("🔗 إدارة الروابط المسموحة", callback_data="admin_manage_links")],
+        [InlineKeyboardButton("⚙️ تعديل رسائل البوت", callback_data="admin_edit_messages")],
+        [InlineKeyboardButton("📵 قائمة من حظر البوت", callback_data="admin_blocked_list")],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    message_text = f"🤖 لوحة تحكم المشرف\n\n{metrics_summary()}\n\nاختر أحد الخيارات لإدارة البوت:"
+    if update.callback_query:
+        try:
+            await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
+        except BadRequest:
+            pass
+    else:
+        await update.effective_message.reply_text(message_text, reply_markup=reply_markup)
+
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "600"))
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+class AdminRosterCache:
+    """
+    قائمة مشرفي كل مجموعة في الذاكرة، تُجلب عبر get_chat_administrators
+    وتنتهي صلاحيتها بعد ADMIN_CACHE_TTL ثانية، وتُحدّث فورًا من تحديثات ChatMemberUpdated.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._rosters = {}
+        self._locks = {}
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0, "member_updates": 0}
+
+    def _fresh_roster(self, chat_id: int):
+        entry = self._rosters.get(chat_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    async def is_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        roster = self._fresh_roster(chat_id)
+        if roster is not None:
+            self.stats["hits"] += 1
+            return user_id in roster
+        self.stats["misses"] += 1
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            # قد يكون طلب آخر قد حدّث القائمة أثناء الانتظار
+            roster = self._fresh_roster(chat_id)
+            if roster is None:
+                try:
+                    administrators = await bot.get_chat_administrators(chat_id)
+                except (BadRequest, Forbidden) as e:
+                    self.stats["errors"] += 1
+                    logger.warning(f"تعذر جلب مشرفي المجموعة {chat_id}: {e}")
+                    return False
+                roster = {member.user.id for member in administrators}
+                self._rosters[chat_id] = (time.monotonic() + self.ttl, roster)
+                self.stats["refreshes"] += 1
+        return user_id in roster
+
+    def apply_member_update(self, chat_id: int, user_id: int, status: str):
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            return
+        self.stats["member_updates"] += 1
+        if status in ADMIN_STATUSES:
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+
+    def invalidate(self, chat_id: int):
+        self._rosters.pop(chat_id, None)
+
+admin_roster_cache = AdminRosterCache(ADMIN_CACHE_TTL)
+
+async def is_user_group_admin(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    يتحقق مما إذا كان المستخدم مشرفًا في المجموعة أو هو المطور (ADMIN_ID).
+    """
+    if user_id == ADMIN_ID:
+        return True
+    return await admin_roster_cache.is_admin(context.bot, chat_id, user_id)
+
+# --- الإشراف المجمّع ومكافحة الإغراق ---
+
+FLOOD_WINDOW_SECONDS = float(os.getenv("FLOOD_WINDOW_SECONDS", "10"))
+FLOOD_MAX_MESSAGES = int(os.getenv("FLOOD_MAX_MESSAGES", "6"))
+FLOOD_RESTRICT_MINUTES = int(os.getenv("FLOOD_RESTRICT_MINUTES", "10"))
+MODERATION_WARNING_COOLDOWN = float(os.getenv("MODERATION_WARNING_COOLDOWN", "60"))
+AUTO_REPLY_COOLDOWN = float(os.getenv("AUTO_REPLY_COOLDOWN", "30"))
+MODERATION_FLUSH_INTERVAL = float(os.getenv("MODERATION_FLUSH_MS", "500")) / 1000
+MODERATION_CONCURRENCY = int(os.getenv("MODERATION_CONCURRENCY", "8"))
+DELETE_MESSAGES_LIMIT = 100 # الحد الأقصى لـ deleteMessages في طلب واحد
+
+moderation_actions = metrics.counter("bot_moderation_actions_total", "إجراءات الإشراف المنفذة أو المدموجة.", ("action",))
+
+class FloodGuard:
+    """
+    يكشف الإغراق بنافذة زمنية منزلقة لكل (مجموعة، مستخدم) في الذاكرة، ويجمع إجراءات الإشراف:
+    الحذف يُرسل دفعات عبر delete_messages، ولكل مستخدم تحذير واحد خلال MODERATION_WARNING_COOLDOWN
+    وتقييد واحد بأطول مدة مطلوبة، والرد التلقائي نفسه لا يتكرر للمستخدم نفسه خلال AUTO_REPLY_COOLDOWN.
+    الإجراءات تُنفذ كل MODERATION_FLUSH_INTERVAL، فعدد طلبات API محدود مهما كان عدد الرسائل.
+    """
+
+    def __init__(self, window: float, max_messages: int, warning_cooldown: float, reply_cooldown: float, flush_interval: float):
+        self.window = window
+        self.max_messages = max_messages
+        self.warning_cooldown = warning_cooldown
+        self.reply_cooldown = reply_cooldown
+        self.flush_interval = flush_interval
+        self._recent = {}
+        self._warned_at = {}
+        self._replied_at = {}
+        self._restricted_until = {}
+        self._deletions = {}
+        self._warnings = {}
+        self._restrictions = {}
+        self._bot = None
+        self._task = None
+        self._slots = asyncio.Semaphore(MODERATION_CONCURRENCY)
+        self.stats = {"flood_detected": 0, "deleted": 0, "warnings_sent": 0, "restrictions_sent": 0, "coalesced": 0, "replies_dropped": 0}
+
+    def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def is_flooding(self, chat_id: int, user_id: int) -> bool:
+        """يسجل رسالة ويعيد True إن تجاوز المستخدم FLOOD_MAX_MESSAGES خلال النافذة."""
+        now = time.monotonic()
+        recent = self._recent.setdefault((chat_id, user_id), deque())
+        recent.append(now)
+        while recent and recent[0] <= now - self.window:
+            recent.popleft()
+        if len(recent) > self.max_messages:
+            if len(recent) == self.max_messages + 1:
+                self.stats["flood_detected"] += 1
+            return True
+        return False
+
+    def punish(self, message, user, warning: str = None, restrict_minutes: int = 0):
+        """يضيف الرسالة لدفعة الحذف، ويدمج التحذير والتقييد مع ما سبق للمستخدم نفسه."""
+        chat_id = message.chat_id
+        key = (chat_id, user.id)
+        self._deletions.setdefault(chat_id, []).append(message.message_id)
+        if warning:
+            last_warning = self._warned_at.get(key)
+            if key in self._warnings or (last_warning and time.monotonic() - last_warning < self.warning_cooldown):
+                self.stats["coalesced"] += 1
+                moderation_actions.inc("warning_coalesced")
+            else:
+                self._warnings[key] = warning
+        if restrict_minutes > 0:
+            until = message.date + timedelta(minutes=restrict_minutes)
+            current = max(filter(None, (self._restrictions.get(key), self._restricted_until.get(key))), default=None)
+            if current is not None and current >= until:
+                self.stats["coalesced"] += 1
+                moderation_actions.inc("restriction_coalesced")
+            else:
+                self._restrictions[key] = until
+        if len(self._deletions[chat_id]) >= DELETE_MESSAGES_LIMIT and self._task is not None:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    def allow_reply(self, chat_id: int, user_id: int, reply: str) -> bool:
+        """يمنع تكرار الرد التلقائي نفسه للمستخدم نفسه في المجموعة خلال AUTO_REPLY_COOLDOWN؛ المستخدمون الآخرون يحصلون عليه."""
+        now = time.monotonic()
+        key = (chat_id, user_id, reply)
+        last_reply = self._replied_at.get(key)
+        if last_reply and now - last_reply < self.reply_cooldown:
+            self.stats["replies_dropped"] += 1
+            moderation_actions.inc("reply_dropped")
+            return False
+        self._replied_at[key] = now
+        return True
+
+    async def _call(self, action: str, coroutine):
+        """
+        ينفذ الطلب ويعيد True عند نجاحه، و False عند فشل مؤقت (RetryAfter أو خطأ شبكة) ليُعاد في الدفعة التالية،
+        و None عند رفض نهائي (صلاحيات ناقصة، رسالة محذوفة...) فلا يُعاد.
+        """
+        try:
+            async with self._slots:
+                await coroutine
+        except RetryAfter as e:
+            seconds = retry_after_seconds(e)
+            logger.warning(f"تجاوز حد تيليجرام أثناء الإشراف ({action})، انتظار {seconds} ثانية.")
+            await asyncio.sleep(seconds)
+            return False
+        except BadRequest as e:
+            # BadRequest فرع من NetworkError في المكتبة لكنه رفض نهائي
+            logger.error(f"فشل إجراء الإشراف {action}: {e}")
+            return None
+        except NetworkError as e:
+            logger.warning(f"خطأ شبكة أثناء إجراء الإشراف {action}، سيُعاد في الدفعة التالية: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"فشل إجراء الإشراف {action}: {e}")
+            return None
+        moderation_actions.inc(action)
+        return True
+
+    async def flush(self):
+        deletions, self._deletions = self._deletions, {}
+        warnings, self._warnings = self._warnings, {}
+        restrictions, self._restrictions = self._restrictions, {}
+        if self._bot is None:
+            return
+        now = time.monotonic()
+
+        async def delete(chat_id, batch):
+            done = await self._call("delete", self._bot.delete_messages(chat_id, batch))
+            if done:
+                self.stats["deleted"] += len(batch)
+            elif done is False:
+                self._deletions.setdefault(chat_id, []).extend(batch)
+
+        async def restrict(key, until):
+            chat_id, user_id = key
+            done = await self._call("restrict", self._bot.restrict_chat_member(
+                chat_id, user_id, permissions=ChatPermissions(can_send_messages=False), until_date=until,
+            ))
+            if done:
+                self._restricted_until[key] = until
+                self.stats["restrictions_sent"] += 1
+            elif done is False and (key not in self._restrictions or self._restrictions[key] < until):
+                self._restrictions[key] = until
+
+        async def warn(key, warning):
+            done = await self._call("warn", self._bot.send_message(key[0], warning, parse_mode=ParseMode.HTML))
+            if done:
+                self._warned_at[key] = now
+                self.stats["warnings_sent"] += 1
+            elif done is False:
+                # تحذير أحدث أُضيف أثناء الانتظار يحل محل هذا
+                self._warnings.setdefault(key, warning)
+
+        await asyncio.gather(
+            *(delete(chat_id, message_ids[start:start + DELETE_MESSAGES_LIMIT])
+              for chat_id, message_ids in deletions.items()
+              for start in range(0, len(message_ids), DELETE_MESSAGES_LIMIT)),
+            *(restrict(key, until) for key, until in restrictions.items()),
+            *(warn(key, warning) for key, warning in warnings.items()),
+        )
+
+    def _prune(self):
+        now = time.monotonic()
+        self._recent = {key: recent for key, recent in self._recent.items() if recent and recent[-1] > now - self.window}
+        self._warned_at = {key: at for key, at in self._warned_at.items() if now - at < self.warning_cooldown}
+        self._replied_at = {key: at for key, at in self._replied_at.items() if now - at < self.reply_cooldown}
+        # التقييدات المنتهية لم تعد تمنع تقييدًا جديدًا
+        self._restricted_until = {
+            key: until for key, until in self._restricted_until.items()
+            if until.timestamp() > time.time()
+        }
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_prune > self.window:
+                self._prune()
+                last_prune = time.monotonic()
+
+flood_guard = FloodGuard(FLOOD_WINDOW_SECONDS, FLOOD_MAX_MESSAGES, MODERATION_WARNING_COOLDOWN, AUTO_REPLY_COOLDOWN, MODERATION_FLUSH_INTERVAL)
+
+# --- محرك البث ---
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    """
+    محدد معدل عام لطلبات البث (حد تيليجرام حوالي 30 رسالة في الثانية).
+    كل مستخدم يستلم رسالة واحدة فقط في كل بث، لذا حد الدردشة الواحدة (رسالة في الثانية) محقق تلقائيًا.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """يوقف كل الإرسال مؤقتًا بعد RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+broadcast_limiter = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+running_broadcasts = {}
+broadcast_messages = metrics.counter("bot_broadcast_messages_total", "نتائج إرسال رسائل البث (sent/blocked/failed/retried).", ("outcome",))
+metrics.callback("bot_broadcasts_running", "مهام البث التي تعمل في هذه النسخة.", "gauge", lambda: len(running_broadcasts))
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+async def create_broadcast_job(message) -> int | None:
+    text = message.text or message.caption
+    entities = message.entities or message.caption_entities
+    photo = message.photo[-1].file_id if message.photo else None
+    video = message.video.file_id if message.video else None
+    if not (text or photo or video):
+        return None
+    row = await db.fetchone(
+        "INSERT INTO broadcast_jobs (text, entities, photo, video) VALUES (%s, %s, %s, %s) RETURNING job_id;",
+        (text, json.dumps([entity.to_dict() for entity in entities]) if entities else None, photo, video),
+    )
+    return row[0]
+
+class BroadcastJob:
+    """
+    بث يعمل في الخلفية بعدد محدود من الإرسالات المتزامنة.
+    التقدم يُحفظ بعد كل دفعة (آخر user_id مكتمل)، فعند إعادة التشغيل يُستأنف البث
+    من آخر دفعة محفوظة بدلاً من إعادة الإرسال للجميع.
+    الحجز يُجدد في مهمة نبض مستقلة طوال الإرسال، ولا يُرسل أي مستخدم بعد انتهاء مهلة آخر تجديد ناجح،
+    وحفظ التقدم مشروط بملكية البث حتى لا تكتب نسخة فقدت الحجز فوق تقدم مالكه الجديد.
+    """
+
+    def __init__(self, job_id, text, entities, photo, video, last_user_id, sent, failed):
+        self.job_id = job_id
+        self.text = text
+        self.entities = entities or []
+        self.photo = photo
+        self.video = video
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self._slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self._progress_message = None
+        self._last_progress = 0.0
+        self._lease_deadline = 0.0
+
+    @classmethod
+    async def load(cls, job_id: int):
+        row = await db.fetchone(
+            "SELECT job_id, text, entities, photo, video, last_user_id, sent, failed FROM broadcast_jobs WHERE job_id = %s AND status = 'running';",
+            (job_id,),
+        )
+        return cls(*row) if row else None
+
+    async def _deliver(self, bot, uid: int):
+        entities = MessageEntity.de_list(self.entities, bot) if self.entities else None
+        if self.photo:
+            await bot.send_photo(uid, self.photo, caption=self.text, caption_entities=entities)
+        elif self.video:
+            await bot.send_video(uid, self.video, caption=self.text, caption_entities=entities)
+        else:
+            await bot.send_message(uid, self.text, entities=entities)
+
+    async def _send_one(self, bot, uid: int, blocked: list):
+        async with self._slots:
+            for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                await broadcast_limiter.acquire()
+                if self.lease_lost():
+                    return
+                try:
+                    await self._deliver(bot, uid)
+                    self.sent += 1
+                    broadcast_messages.inc("sent")
+                    return
+                except RetryAfter as e:
+                    broadcast_messages.inc("retried")
+                    seconds = retry_after_seconds(e)
+                    logger.warning(f"تجاوز حد تيليجرام أثناء البث {self.job_id}، انتظار {seconds} ثانية.")
+                    broadcast_limiter.pause(seconds)
+                except Forbidden:
+                    logger.warning(f"المستخدم {uid} حظر البوت. سيتم نقله إلى قائمة الحظر.")
+                    # الاسم يُجلب لاحقًا عند عرض قائمة الحظر، حتى لا يكلف كل محظور طلب get_chat أثناء البث
+                    blocked.append((uid, None, None))
+                    self.failed += 1
+                    broadcast_messages.inc("blocked")
+                    return
+                except Exception as e:
+                    logger.error(f"فشل البث للمستخدم {uid}: {e}")
+                    self.failed += 1
+                    broadcast_messages.inc("failed")
+                    return
+            logger.error(f"فشل البث للمستخدم {uid} بعد {BROADCAST_MAX_RETRIES} محاولات.")
+            self.failed += 1
+            broadcast_messages.inc("failed")
+
+    def lease_lost(self) -> bool:
+        return time.monotonic() >= self._lease_deadline
+
+    async def _heartbeat(self):
+        """يجدد الحجز كل ثلث مدة العقد، ويتوقف عند فقدانه فتتوقف الإرسالات عند انتهاء المهلة."""
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 3)
+            renewed_at = time.monotonic()
+            try:
+                claimed = await state_backend.claim_broadcast(self.job_id)
+            except psycopg2.Error as e:
+                logger.error(f"فشل تجديد حجز البث رقم {self.job_id}: {e}")
+                continue
+            if not claimed:
+                self._lease_deadline = 0.0
+                logger.warning(f"انتقلت ملكية البث رقم {self.job_id} إلى نسخة أخرى، سيتوقف هنا.")
+                return
+            self._lease_deadline = renewed_at + BROADCAST_LEASE_SECONDS
+
+    def _checkpoint(self, cur, blocked: list, last_user_id: int) -> bool:
+        cur.execute(
+            "UPDATE broadcast_jobs SET last_user_id = %s, sent = %s, failed = %s WHERE job_id = %s AND owner IS NOT DISTINCT FROM %s;",
+            (last_user_id, self.sent, self.failed, self.job_id, state_backend.broadcast_owner),
+        )
+        if cur.rowcount == 0:
+            return False
+        if blocked:
+            execute_values(cur, """
+                INSERT INTO blocked_users (user_id, full_name, username) 
+                VALUES %s 
+                ON CONFLICT (user_id) DO UPDATE SET 
+                    full_name = COALESCE(EXCLUDED.full_name, blocked_users.full_name), 
+                    username = COALESCE(EXCLUDED.username, blocked_users.username),
+                    blocked_date = NOW();
+            """, blocked)
+            cur.execute("DELETE FROM users WHERE user_id = ANY(%s);", ([uid for uid, _, _ in blocked],))
+        return True
+
+    async def _report_progress(self, bot, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        if final:
+            text = f"✅ انتهى البث رقم {self.job_id}!\nنجح: {self.sent}, فشل: {self.failed}"
+        else:
+            text = f"📢 البث رقم {self.job_id} قيد التنفيذ...\nنجح: {self.sent}, فشل: {self.failed}"
+        try:
+            if self._progress_message is None or final:
+                self._progress_message = await bot.send_message(ADMIN_ID, text)
+            else:
+                await self._progress_message.edit_text(text)
+        except (BadRequest, Forbidden, RetryAfter) as e:
+            logger.warning(f"تعذر تحديث تقدم البث {self.job_id}: {e}")
+
+    @staticmethod
+    async def _fetch_page(after_user_id: int):
+        rows = await db.fetchall(
+            "SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s;",
+            (after_user_id, BROADCAST_CHUNK_SIZE),
+        )
+        return [row[0] for row in rows]
+
+    async def _recipients(self):
+        """
+        يمرّر المستلمين على صفحات بترقيم المفتاح (user_id > آخر معرف) عبر فهرس المفتاح الأساسي،
+        فتبقى الذاكرة وزمن أول إرسال ثابتين مهما كبر الجدول. الصفحة التالية تُجلب أثناء إرسال الحالية.
+        """
+        page = await self._fetch_page(self.last_user_id)
+        while page:
+            next_page = asyncio.create_task(self._fetch_page(page[-1]))
+            try:
+                yield page
+            except BaseException:
+                next_page.cancel()
+                raise
+            page = await next_page
+
+    async def run(self, bot):
+        # start_broadcast حجز البث للتو، فالمهلة تبدأ من هنا
+        self._lease_deadline = time.monotonic() + BROADCAST_LEASE_SECONDS
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self._run(bot)
+        finally:
+            heartbeat.cancel()
+
+    async def _run(self, bot):
+        logger.info(f"بدء البث رقم {self.job_id} من المستخدم {self.last_user_id}.")
+        await self._report_progress(bot)
+        async for chunk in self._recipients():
+            blocked = []
+            await asyncio.gather(*(self._send_one(bot, uid, blocked) for uid in chunk))
+            # دفعة لم تكتمل لانتهاء المهلة لا تُحفظ، فيستأنفها المالك التالي من آخر نقطة محفوظة
+            if self.lease_lost() or not await db.run(self._checkpoint, blocked, chunk[-1]):
+                logger.warning(f"فقدت هذه النسخة حجز البث رقم {self.job_id}، سيتوقف هنا.")
+                return
+            self.last_user_id = chunk[-1]
+            if blocked:
+                blocked_ids = [uid for uid, _, _ in blocked]
+                user_registry.mark_blocked(blocked_ids)
+                await state_backend.publish("users_blocked", blocked_ids)
+            await self._report_progress(bot)
+        finished = await db.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = NOW() WHERE job_id = %s AND owner IS NOT DISTINCT FROM %s;",
+            (self.job_id, state_backend.broadcast_owner),
+        )
+        if not finished:
+            logger.warning(f"فقدت هذه النسخة حجز البث رقم {self.job_id} قبل إنهائه.")
+            return
+        await self._report_progress(bot, final=True)
+        logger.info(f"انتهى البث رقم {self.job_id}: نجح {self.sent}، فشل {self.failed}.")
+
+async def _run_broadcast(application: Application, job: BroadcastJob):
+    try:
+        await job.run(application.bot)
+    except Exception as e:
+        logger.error(f"توقف البث رقم {job.job_id} وسيُستأنف في الفحص التالي: {e}")
+    finally:
+        running_broadcasts.pop(job.job_id, None)
+
+async def start_broadcast(application: Application, job_id: int) -> bool:
+    if job_id in running_broadcasts:
+        return False
+    if not await state_backend.claim_broadcast(job_id):
+        return False
+    job = await BroadcastJob.load(job_id)
+    if job is None:
+        return False
+    # مهمة asyncio عادية وليست application.create_task حتى لا ينتظر الإيقاف انتهاء البث كاملًا
+    running_broadcasts[job_id] = asyncio.create_task(_run_broadcast(application, job))
+    return True
+
+async def stop_broadcasts():
+    job_ids = list(running_broadcasts)
+    tasks = list(running_broadcasts.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # تحرير الحجز حتى تستأنفها نسخة أخرى فورًا بدل انتظار انتهاء العقد
+    for job_id in job_ids:
+        try:
+            await state_backend.release_broadcast(job_id)
+        except psycopg2.Error as e:
+            logger.error(f"فشل تحرير البث رقم {job_id}: {e}")
+
+async def resume_broadcasts(application: Application):
+    rows = await db.fetchall("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id;")
+    for (job_id,) in rows:
+        if await start_broadcast(application, job_id):
+            logger.info(f"استئناف البث رقم {job_id}.")
+
+async def supervise_broadcasts(application: Application):
+    """يلتقط مهام البث المتوقفة أو التي انتهى عقد نسختها، بعد إعادة التشغيل أو توقف نسخة أخرى."""
+    while True:
+        try:
+            await resume_broadcasts(application)
+        except psycopg2.Error as e:
+            logger.error(f"فشل فحص مهام البث المعلقة: {e}")
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS / 2)
+
+# --- خط تحميل الوسائط ---
+
+DOWNLOAD_FOLDER = "downloads"
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "3"))
+DOWNLOAD_PER_USER_LIMIT = int(os.getenv("DOWNLOAD_PER_USER_LIMIT", "1"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "600"))
+DOWNLOAD_MAX_FILESIZE = 50 * 1024 * 1024 # 50MB
+DOWNLOAD_DISK_QUOTA = int(os.getenv("DOWNLOAD_DISK_QUOTA_MB", "200")) * 1024 * 1024
+DOWNLOAD_UPLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_UPLOAD_TIMEOUT", "120"))
 
-# استيراد مكتبة yt-dlp
-import yt_dlp
+MEDIA_CACHE_TTL_DAYS = int(os.getenv("MEDIA_CACHE_TTL_DAYS", "30"))
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "50000"))
+MEDIA_CACHE_EVICT_EVERY = int(os.getenv("MEDIA_CACHE_EVICT_EVERY", "100"))
+DOWNLOAD_SIZE_BUCKETS = tuple(n * 1024 * 1024 for n in (1, 2, 5, 10, 20, 30, 40, 50))
 
-# استيراد مكتبة تحميل متغيرات البيئة
-from dotenv import load_dotenv
+download_phase_seconds = metrics.histogram("bot_download_phase_seconds", "زمن كل مرحلة من مهمة التحميل (queue/download/upload).", ("phase",))
+download_file_bytes = metrics.histogram("bot_download_file_size_bytes", "حجم الملفات المحمّلة قبل رفعها.", buckets=DOWNLOAD_SIZE_BUCKETS)
 
-# --- الإعدادات الأولية ---
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid", "igsh", "ref", "ref_src", "s", "t"}
 
-load_dotenv()
+def normalize_media_url(url: str) -> str:
+    """يوحّد الرابط حتى تُعتبر صيغ الرابط نفسه مفتاحًا واحدًا."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+    )
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit(("https", host, path, urlencode(query), ""))
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-ADMIN_ID_STR = os.getenv("ADMIN_ID")
-DATABASE_URL = os.getenv("DATABASE_URL")
+class MediaCache:
+    """
+    يربط الرابط الموحّد ومعرّف الفيديو لدى المستخرج (extractor:id) بـ file_id الذي أعاده تيليجرام بعد أول رفع،
+    فالطلبات المكررة تُجاب بإعادة إرسال file_id دون تحميل أو رفع.
+    الإدخالات التي لم تُستخدم منذ MEDIA_CACHE_TTL_DAYS تُحذف، ويُحتفظ بأحدث MEDIA_CACHE_MAX_ENTRIES فقط.
+    """
 
-if not all([TELEGRAM_TOKEN, ADMIN_ID_STR, DATABASE_URL]):
-    logger.critical("خطأ فادح: أحد متغيرات البيئة (TELEGRAM_TOKEN, ADMIN_ID, DATABASE_URL) غير موجود.")
-    exit()
+    def __init__(self, ttl_days: int, max_entries: int, evict_every: int):
+        self.ttl_days = ttl_days
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._puts_since_evict = 0
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "purged": 0, "evicted": 0}
 
-ADMIN_ID = int(ADMIN_ID_STR)
+    @staticmethod
+    def url_key(url: str) -> str:
+        return "url:" + normalize_media_url(url)
 
-# --- إدارة قاعدة بيانات PostgreSQL ---
+    @staticmethod
+    def info_key(info: dict) -> str | None:
+        if not info.get("id") or not info.get("extractor_key"):
+            return None
+        return f"id:{info['extractor_key'].lower()}:{info['id']}"
 
-def get_db_connection():
-    try:
-        return psycopg2.connect(DATABASE_URL)
-    except psycopg2.OperationalError as e:
-        logger.error(f"لا يمكن الاتصال بقاعدة البيانات: {e}")
-        return None
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
 
-def setup_database():
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY);")
-            cur.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);")
-            cur.execute("CREATE TABLE IF NOT EXISTS auto_replies (keyword TEXT PRIMARY KEY, reply TEXT NOT NULL);")
-            cur.execute("CREATE TABLE IF NOT EXISTS banned_words (word TEXT PRIMARY KEY, duration_minutes INTEGER NOT NULL, warning_message TEXT);")
-            cur.execute("CREATE TABLE IF NOT EXISTS allowed_links (link_pattern TEXT PRIMARY KEY);")
-            
-            # --- تعديل: إضافة حقول لاسم المستخدم والمعرف ---
+    async def get(self, key: str):
+        """يعيد (file_id, title) ويحدّث وقت آخر استخدام، أو None."""
+        row = await db.fetchone(
+            "UPDATE media_cache SET hits = hits + 1, last_used_at = NOW() "
+            "WHERE cache_key = %s AND last_used_at > NOW() - make_interval(days => %s) RETURNING file_id, title;",
+            (key, self.ttl_days),
+        )
+        self.stats["hits" if row else "misses"] += 1
+        return row
+
+    async def put(self, keys, file_id: str, title: str):
+        def _put(cur):
+            execute_values(cur, """
+                INSERT INTO media_cache (cache_key, file_id, title) VALUES %s
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    file_id = EXCLUDED.file_id,
+                    title = EXCLUDED.title,
+                    last_used_at = NOW();
+            """, [(key, file_id, title) for key in keys])
+        await db.run(_put)
+        self.stats["stored"] += 1
+        self._puts_since_evict += 1
+        if self._puts_since_evict >= self.evict_every:
+            self._puts_since_evict = 0
+            await self.evict()
+
+    async def evict(self):
+        def _evict(cur):
+            cur.execute("DELETE FROM media_cache WHERE last_used_at < NOW() - make_interval(days => %s);", (self.ttl_days,))
+            expired = cur.rowcount
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS blocked_users (
-                    user_id BIGINT PRIMARY KEY, 
-                    full_name TEXT,
-                    username TEXT,
-                    blocked_date TIMESTAMPTZ DEFAULT NOW()
+                DELETE FROM media_cache WHERE cache_key IN (
+                    SELECT cache_key FROM media_cache ORDER BY last_used_at DESC OFFSET %s
                 );
-            """)
-            
-            cur.execute("INSERT INTO settings (key, value) VALUES ('welcome_message', 'أهلاً بك في البوت!') ON CONFLICT (key) DO NOTHING;")
-            cur.execute("INSERT INTO settings (key, value) VALUES ('forward_reply_message', 'شكرًا لرسالتك، تم توصيلها للدعم وسنرد عليك قريبًا.') ON CONFLICT (key) DO NOTHING;")
-        conn.commit()
-        logger.info("تم فحص وتحديث قاعدة البيانات بنجاح.")
-    finally:
-        if conn:
-            conn.close()
+            """, (self.max_entries,))
+            return expired + cur.rowcount
+        evicted = await db.run(_evict)
+        self.stats["evicted"] += evicted
+        if evicted:
+            logger.info(f"تم حذف {evicted} عنصر قديم من ذاكرة الوسائط.")
 
-# --- دوال مساعدة ---
+    async def purge(self, url: str | None = None) -> int:
+        """يحذف إدخال رابط واحد (وكل المفاتيح المرتبطة بنفس file_id)، أو كل الذاكرة إذا لم يُحدد رابط."""
+        if url is None:
+            purged = await db.execute("DELETE FROM media_cache;")
+        else:
+            purged = await db.execute(
+                "DELETE FROM media_cache WHERE file_id IN (SELECT file_id FROM media_cache WHERE cache_key = %s);",
+                (self.url_key(url),),
+            )
+        self.stats["purged"] += purged
+        return purged
 
-def escape_markdown(text: str) -> str:
-    """تهريب الأحرف الخاصة في MarkdownV2."""
-    if not text:
-        return ""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    async def forget_file(self, file_id: str):
+        purged = await db.execute("DELETE FROM media_cache WHERE file_id = %s;", (file_id,))
+        self.stats["purged"] += purged
 
-async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("📢 بث رسالة للجميع", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("📝 إدارة الردود التلقائية", callback_data="admin_manage_replies")],
-        [InlineKeyboardButton("🚫 إدارة الكلمات المحظورة", callback_data="admin_manage_banned")],
-        [InlineKeyboardButton("🔗 إدارة الروابط المسموحة", callback_data="admin_manage_links")],
-        [InlineKeyboardButton("⚙️ تعديل رسائل البوت", callback_data="admin_edit_messages")],
-        [InlineKeyboardButton("📵 قائمة من حظر البوت", callback_data="admin_blocked_list")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    message_text = "🤖 لوحة تحكم المشرف\n\nاختر أحد الخيارات لإدارة البوت:"
-    if update.callback_query:
+media_cache = MediaCache(MEDIA_CACHE_TTL_DAYS, MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_EVICT_EVERY)
+
+async def send_cached_media(bot, chat_id: int, key: str) -> bool:
+    """يرسل الفيديو من الذاكرة إن وُجد. file_id غير الصالح يُحذف ويُعاد False ليتم التحميل من جديد."""
+    try:
+        cached = await media_cache.get(key)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قراءة ذاكرة الوسائط: {e}")
+        return False
+    if not cached:
+        return False
+    file_id, title = cached
+    try:
+        await bot.send_video(chat_id=chat_id, video=file_id, caption=title or '✅ تم التحميل')
+        return True
+    except BadRequest as e:
+        logger.warning(f"file_id محفوظ غير صالح، سيتم حذفه: {e}")
+        await media_cache.forget_file(file_id)
+        return False
+
+class DownloadJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, bot, user_id: int, chat_id: int, url: str):
+        self.job_id = next(self._ids)
+        self.bot = bot
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.url = url
+        self.status_message = None
+        self.state = "queued"
+        self.cancel_event = threading.Event()
+        self.enqueued_at = time.monotonic()
+        self.deadline = None
+        self.workspace = None
+        self.ydl = None
+        self.reserved_bytes = 0
+        self.too_large = False
+        self.abandoned_future = None
+
+    def cancel_markup(self):
+        return InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء", callback_data=f"download_cancel_{self.job_id}")]])
+
+    def cancel_hook(self, progress):
+        """يُستدعى من yt-dlp داخل خيط التحميل، ويوقفه عند الإلغاء أو انتهاء المهلة أو تجاوز المساحة المحجوزة."""
+        if (progress.get("downloaded_bytes") or 0) > self.reserved_bytes:
+            self.too_large = True
+            raise load_yt_dlp().utils.DownloadCancelled()
+        if self.cancel_event.is_set():
+            raise load_yt_dlp().utils.DownloadCancelled()
+
+@functools.cache
+def load_yt_dlp():
+    """يستورد yt-dlp عند أول تحميل، داخل خيط التحميل حتى لا يوقف حلقة الأحداث."""
+    import yt_dlp
+    return yt_dlp
+
+class DownloadManager:
+    """
+    طابور تحميل بعدد ثابت من العمال، حتى لا يوقف yt-dlp حلقة الأحداث.
+    التحميل نفسه يعمل في خيوط منفصلة، مع حد أقصى لكل مستخدم وحد عام بعدد العمال.
+    كل مهمة تعمل في مجلد مؤقت خاص بها يُحذف دائمًا عند انتهائها، ولا تبدأ التحميل
+    إلا بعد فحص البيانات الوصفية وحجز المساحة اللازمة من DOWNLOAD_DISK_QUOTA.
+    مجلدات المهام داخل مجلد خاص بالنسخة (DOWNLOAD_FOLDER/INSTANCE_ID) مقفل بـ flock طوال عمرها،
+    فلا تحذف نسخة تعمل في المجلد نفسه إلا مجلدات نسخ توقفت.
+    """
+
+    def __init__(self, workers: int, per_user_limit: int, timeout: float, disk_quota: int):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.timeout = timeout
+        self.disk_quota = disk_quota
+        self._executor = None
+        self.root = os.path.join(DOWNLOAD_FOLDER, INSTANCE_ID)
+        self._root_lock = None
+        self._queue = asyncio.Queue()
+        self._pending = deque()
+        self._jobs = {}
+        self._user_jobs = {}
+        self._active = 0
+        self._worker_tasks = []
+        self._reserved_bytes = 0
+        self._disk_freed = asyncio.Condition()
+        self.stats = {
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "timed_out": 0,
+            "rejected": 0,
+            "queue_wait_seconds_total": 0.0,
+            "download_seconds_total": 0.0,
+            "upload_seconds_total": 0.0,
+        }
+
+    def start(self):
+        os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+        # القفل قبل المجلد: أي مجلد موجود إما أن قفله ممسوك أو أن صاحبه توقف
+        self._root_lock = open(self.root + ".lock", "w")
+        fcntl.flock(self._root_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.makedirs(self.root)
+        self._remove_stale_workspaces()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="download")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for job in self._jobs.values():
+            job.cancel_event.set()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._root_lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.remove(self._root_lock.name)
+            self._root_lock.close()
+            self._root_lock = None
+
+    @staticmethod
+    def _remove_stale_workspaces():
+        """يحذف مجلدات النسخ المتوقفة (قفلها غير ممسوك) ومجلدات المهام القديمة من قبل المجلد الخاص بالنسخة."""
+        for name in os.listdir(DOWNLOAD_FOLDER):
+            path = os.path.join(DOWNLOAD_FOLDER, name)
+            if name == INSTANCE_ID or not os.path.isdir(path):
+                continue
+            with open(path + ".lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                os.remove(lock.name)
+                logger.info(f"تم حذف مجلد تحميل متبقٍ من نسخة متوقفة: {name}")
+
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def active_count(self) -> int:
+        return self._active
+
+    def reserved_bytes(self) -> int:
+        return self._reserved_bytes
+
+    def reserve(self, job: DownloadJob):
+        """يحجز مكانًا للمهمة ويعيد ترتيبها في الطابور (0 = تبدأ فورًا)، أو None عند تجاوز حد المستخدم."""
+        if self._user_jobs.get(job.user_id, 0) >= self.per_user_limit:
+            return None
+        self._user_jobs[job.user_id] = self._user_jobs.get(job.user_id, 0) + 1
+        self._jobs[job.job_id] = job
+        self._pending.append(job)
+        idle_workers = self.workers - self._active
+        return max(0, len(self._pending) - idle_workers)
+
+    def enqueue(self, job: DownloadJob):
+        self._queue.put_nowait(job)
+
+    def discard(self, job: DownloadJob):
+        """يلغي حجزًا لم يدخل الطابور بعد (مثلًا عند فشل إرسال رسالة الحالة)."""
+        self._pending.remove(job)
+        self._release(job)
+
+    def _release(self, job: DownloadJob):
+        self._jobs.pop(job.job_id, None)
+        remaining = self._user_jobs.get(job.user_id, 1) - 1
+        if remaining > 0:
+            self._user_jobs[job.user_id] = remaining
+        else:
+            self._user_jobs.pop(job.user_id, None)
+
+    async def cancel(self, job_id: int, user_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return False
+        job.cancel_event.set()
+        if job.state == "queued":
+            job.state = "cancelled"
+            self._pending.remove(job)
+            self._release(job)
+            self.stats["cancelled"] += 1
+            await self._set_status(job, "تم إلغاء التحميل.")
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.state == "cancelled":
+                continue
+            self._pending.remove(job)
+            self._active += 1
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"خطأ غير متوقع في مهمة التحميل {job.job_id}: {e}")
+            finally:
+                self._active -= 1
+                self._release(job)
+
+    async def _reserve_disk(self, job: DownloadJob, size: int):
+        async with self._disk_freed:
+            await self._disk_freed.wait_for(lambda: self._reserved_bytes + size <= self.disk_quota)
+            self._reserved_bytes += size
+            job.reserved_bytes = size
+
+    async def _release_disk(self, job: DownloadJob):
+        if not job.reserved_bytes:
+            return
+        async with self._disk_freed:
+            self._reserved_bytes -= job.reserved_bytes
+            job.reserved_bytes = 0
+            self._disk_freed.notify_all()
+
+    def _open_workspace(self, job: DownloadJob):
+        job.workspace = tempfile.mkdtemp(prefix=f"job{job.job_id}_", dir=self.root)
+        job.ydl = load_yt_dlp().YoutubeDL({
+            'format': 'best',
+            'outtmpl': os.path.join(job.workspace, '%(id)s.%(ext)s'),
+            'quiet': True,
+            'noplaylist': True,
+            'max_filesize': DOWNLOAD_MAX_FILESIZE,
+            'progress_hooks': [job.cancel_hook],
+        })
+
+    async def _close_workspace(self, job: DownloadJob):
+        if job.ydl is not None:
+            job.ydl.close()
+            job.ydl = None
+        if job.workspace is not None:
+            shutil.rmtree(job.workspace, ignore_errors=True)
+            job.workspace = None
+        await self._release_disk(job)
+
+    async def _in_thread(self, job: DownloadJob, func, *args):
+        """ينفذ استدعاء yt-dlp في خيط التحميل ضمن المهلة المتبقية للمهمة."""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args))
         try:
-            await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
+            return await asyncio.wait_for(asyncio.shield(future), job.deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            job.cancel_event.set()
+            job.abandoned_future = future
+            raise
+
+    @staticmethod
+    def _expected_size(info: dict):
+        return info.get('filesize') or info.get('filesize_approx')
+
+    def _rejection_reason(self, info: dict):
+        if info.get('_type') in ('playlist', 'multi_video'):
+            return "❌ قوائم التشغيل غير مدعومة. أرسل رابط فيديو واحد."
+        if info.get('is_live'):
+            return "❌ لا يمكن تحميل البث المباشر."
+        expected_size = self._expected_size(info)
+        if expected_size and expected_size > DOWNLOAD_MAX_FILESIZE:
+            return f"❌ حجم الفيديو أكبر من الحد المسموح ({DOWNLOAD_MAX_FILESIZE // (1024 * 1024)} ميغابايت)."
+        return None
+
+    @staticmethod
+    def _downloaded_path(job: DownloadJob, info: dict) -> str:
+        downloads = info.get('requested_downloads')
+        if downloads and downloads[0].get('filepath'):
+            return downloads[0]['filepath']
+        return job.ydl.prepare_filename(info)
+
+    async def _remember(self, job: DownloadJob, info: dict, sent):
+        media = sent.video or sent.document or sent.animation
+        if media is None:
+            return
+        keys = [media_cache.url_key(job.url)]
+        info_key = media_cache.info_key(info)
+        if info_key:
+            keys.append(info_key)
+        try:
+            await media_cache.put(keys, media.file_id, info.get('title'))
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حفظ الفيديو في ذاكرة الوسائط: {e}")
+
+    async def _set_status(self, job: DownloadJob, text: str, with_cancel: bool = False):
+        try:
+            await job.status_message.edit_text(text, reply_markup=job.cancel_markup() if with_cancel else None)
         except BadRequest:
             pass
-    else:
-        await update.effective_message.reply_text(message_text, reply_markup=reply_markup)
 
-async def is_user_group_admin(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    async def _process(self, job: DownloadJob):
+        job.state = "running"
+        started = time.monotonic()
+        job.deadline = started + self.timeout
+        queue_wait = started - job.enqueued_at
+        self.stats["queue_wait_seconds_total"] += queue_wait
+        download_phase_seconds.observe(queue_wait, "queue")
+        if queue_wait > 1:
+            await self._set_status(job, "⏳ جاري فحص الرابط...", with_cancel=True)
+
+        await asyncio.get_running_loop().run_in_executor(self._executor, load_yt_dlp)
+        self._open_workspace(job)
+        try:
+            # فحص البيانات الوصفية فقط، دون تحميل أي جزء من الملف
+            info = await self._in_thread(job, job.ydl.extract_info, job.url, False)
+            rejection = self._rejection_reason(info)
+            if rejection:
+                self.stats["rejected"] += 1
+                await self._set_status(job, rejection)
+                return
+
+            info_key = media_cache.info_key(info)
+            if info_key and await send_cached_media(job.bot, job.chat_id, info_key):
+                await job.status_message.delete()
+                return
+
+            # الحجم المعلن تقديري أحيانًا، لذا نحجز هامشًا إضافيًا ضمن الحد الأقصى
+            expected_size = self._expected_size(info)
+            reservation = min(int(expected_size * 1.2), DOWNLOAD_MAX_FILESIZE) if expected_size else DOWNLOAD_MAX_FILESIZE
+            await asyncio.wait_for(self._reserve_disk(job, reservation), job.deadline - time.monotonic())
+            await self._set_status(job, "⏳ جاري التحميل...", with_cancel=True)
+            info = await self._in_thread(job, job.ydl.process_ie_result, info, True)
+            filename = self._downloaded_path(job, info)
+            downloaded = time.monotonic()
+            download_file_bytes.observe(os.path.getsize(filename))
+
+            # الرفع يقرأ الملف من القرص أثناء الإرسال بدلًا من تحميله كاملًا في الذاكرة
+            with open(filename, 'rb') as video:
+                sent = await job.bot.send_video(
+                    chat_id=job.chat_id,
+                    video=InputFile(video, read_file_handle=False),
+                    caption=info.get('title', '✅ تم التحميل'),
+                    write_timeout=DOWNLOAD_UPLOAD_TIMEOUT,
+                )
+            uploaded = time.monotonic()
+            await self._remember(job, info, sent)
+            await job.status_message.delete()
+        except asyncio.TimeoutError:
+            self.stats["timed_out"] += 1
+            logger.error(f"انتهت مهلة التحميل {job.job_id} ({self.timeout} ثانية): {job.url}")
+            await self._set_status(job, "❌ استغرق التحميل وقتًا أطول من المسموح.")
+            return
+        except Exception as e:
+            if job.too_large:
+                self.stats["rejected"] += 1
+                await self._set_status(job, "❌ حجم الفيديو أكبر من المتوقع أو من الحد المسموح.")
+            elif job.cancel_event.is_set():
+                self.stats["cancelled"] += 1
+                await self._set_status(job, "تم إلغاء التحميل.")
+            else:
+                self.stats["failed"] += 1
+                logger.error(f"خطأ في تحميل الفيديو باستخدام yt-dlp: {e}")
+                await self._set_status(job, "❌ حدث خطأ أثناء التحميل. قد يكون الفيديو خاصًا، محذوفًا، أو من منصة غير مدعومة حاليًا.")
+            return
+        finally:
+            job.state = "done"
+            if job.abandoned_future is not None and not job.abandoned_future.done():
+                # الخيط سيتوقف عند أول استدعاء لـ cancel_hook، وننظف مجلده حينها
+                def _abandoned_done(done):
+                    if not done.cancelled():
+                        done.exception()
+                    asyncio.get_running_loop().create_task(self._close_workspace(job))
+                job.abandoned_future.add_done_callback(_abandoned_done)
+            else:
+                await self._close_workspace(job)
+
+        self.stats["completed"] += 1
+        self.stats["download_seconds_total"] += downloaded - started
+        self.stats["upload_seconds_total"] += uploaded - downloaded
+        download_phase_seconds.observe(downloaded - started, "download")
+        download_phase_seconds.observe(uploaded - downloaded, "upload")
+        logger.info(
+            f"مهمة التحميل {job.job_id}: انتظار {queue_wait:.1f}ث، تحميل {downloaded - started:.1f}ث، رفع {uploaded - downloaded:.1f}ث."
+        )
+
+download_manager = DownloadManager(DOWNLOAD_WORKERS, DOWNLOAD_PER_USER_LIMIT, DOWNLOAD_TIMEOUT, DOWNLOAD_DISK_QUOTA)
+metrics.callback("bot_download_queue_depth", "مهام التحميل المنتظرة في الطابور.", "gauge", download_manager.queue_depth)
+metrics.callback("bot_download_active", "مهام التحميل قيد التنفيذ.", "gauge", download_manager.active_count)
+metrics.callback("bot_download_reserved_bytes", "المساحة المحجوزة حاليًا من حصة القرص.", "gauge", download_manager.reserved_bytes)
+metrics.callback("bot_download_jobs_total", "عدّادات مهام التحميل (download_manager.stats).", "counter", lambda: download_manager.stats, "stat")
+metrics.callback("bot_media_cache_total", "عدّادات ذاكرة الوسائط (media_cache.stats).", "counter", lambda: media_cache.stats, "stat")
+
+# --- قوائم لوحة المشرف ---
+
+ADMIN_LIST_PAGE_SIZE = int(os.getenv("ADMIN_LIST_PAGE_SIZE", "20"))
+ADMIN_LIST_CACHE_TTL = float(os.getenv("ADMIN_LIST_CACHE_TTL", "60"))
+ADMIN_LIST_CACHE_MAX = int(os.getenv("ADMIN_LIST_CACHE_MAX", "200"))
+# فوق هذا العدد التقريبي يُعرض تقدير pg_class.reltuples بدل COUNT(*) الذي يمر على الجدول كاملًا
+ADMIN_LIST_EXACT_COUNT_LIMIT = int(os.getenv("ADMIN_LIST_EXACT_COUNT_LIMIT", "10000"))
+TELEGRAM_TEXT_LIMIT = 4096
+ADMIN_LIST_LINE_LIMIT = 300
+
+class AdminListView:
     """
-    يتحقق مما إذا كان المستخدم مشرفًا في المجموعة أو هو المطور (ADMIN_ID).
+    قائمة في لوحة المشرف بترقيم المفتاح: كل صفحة تبدأ بعد مفتاح آخر صف ظاهر في الصفحة السابقة،
+    فالاستعلام يمر على الفهرس مباشرة مهما كان رقم الصفحة.
     """
-    if user_id == ADMIN_ID:
-        return True
+
+    def __init__(self, name, title, empty_text, back, table, columns, key_columns, format_row, version, descending=False, markdown=False, enrich=None):
+        self.name = name
+        self.title = title
+        self.empty_text = empty_text
+        self.back = back
+        self.table = table
+        self.columns = columns
+        self.key_columns = key_columns
+        self.format_row = format_row
+        self.version = version
+        self.descending = descending
+        self.markdown = markdown
+        self.enrich = enrich
+
+    async def load_page(self, bot, cursor):
+        rows = await db.fetchall(*self.page_query(cursor))
+        return await self.enrich(bot, rows) if self.enrich else rows
+
+    def page_query(self, cursor):
+        order = ", ".join(f"{column} DESC" if self.descending else column for column in self.key_columns)
+        where, params = "", []
+        if cursor is not None:
+            placeholders = ", ".join(["%s"] * len(cursor))
+            where = f" WHERE ({', '.join(self.key_columns)}) {'<' if self.descending else '>'} ({placeholders})"
+            params = list(cursor)
+        query = f"SELECT {', '.join(self.columns)} FROM {self.table}{where} ORDER BY {order} LIMIT %s;"
+        return query, params + [ADMIN_LIST_PAGE_SIZE + 1]
+
+    def count_rows(self, cur) -> str:
+        """العدد الدقيق للجداول الصغيرة، وتقدير الإحصاءات (~N) للكبيرة؛ reltuples = -1 قبل أول ANALYZE."""
+        cur.execute("SELECT reltuples::BIGINT FROM pg_class WHERE oid = to_regclass(%s);", (self.table,))
+        row = cur.fetchone()
+        if row and row[0] >= ADMIN_LIST_EXACT_COUNT_LIMIT:
+            return f"~{row[0]}"
+        cur.execute(f"SELECT COUNT(*) FROM {self.table};")
+        return str(cur.fetchone()[0])
+
+    def cursor_of(self, row) -> list:
+        values = [row[self.columns.index(column)] for column in self.key_columns]
+        return [value.isoformat() if hasattr(value, "isoformat") else value for value in values]
+
+    def render(self, rows, total: str, page: int):
+        """يعيد (النص، عدد الصفوف الظاهرة) دون تجاوز حد تيليجرام لطول الرسالة."""
+        header = f"{self.title} ({total})" + (f" - صفحة {page + 1}" if page or len(rows) > ADMIN_LIST_PAGE_SIZE else "")
+        text = (escape_markdown(header) if self.markdown else header) + "\n\n"
+        if not rows:
+            return text + (escape_markdown(self.empty_text) if self.markdown else self.empty_text), 0
+        shown = 0
+        for row in rows[:ADMIN_LIST_PAGE_SIZE]:
+            line = self.format_row(row)[:ADMIN_LIST_LINE_LIMIT]
+            if shown and len(text) + len(line) + 2 > TELEGRAM_TEXT_LIMIT:
+                break
+            text += ("\n\n" if self.markdown and shown else "\n" if shown else "") + line
+            shown += 1
+        return text, shown
+
+class AdminListPager:
+    """يخزن الصفحات والعدد الكلي مؤقتًا لكل إصدار من البيانات، فالتنقل ذهابًا وإيابًا لا يعيد الاستعلام."""
+
+    def __init__(self, ttl: float, max_pages: int):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._cache = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def _cached(self, key, loader):
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > now:
+            self.stats["hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        value = await loader()
+        self._cache.pop(key, None)
+        while len(self._cache) >= self.max_pages:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = (now + self.ttl, value)
+        return value
+
+    async def show(self, view: AdminListView, query, state: dict, page: int):
+        """يعرض الصفحة page، ومؤشرات الصفحات تُحفظ في حالة المحادثة المشتركة حتى يعمل السابق/التالي على أي نسخة."""
+        all_cursors = state.setdefault('list_cursors', {})
+        cursors = all_cursors.get(view.name)
+        if page <= 0 or not cursors or page >= len(cursors):
+            page, cursors = 0, [None]
+        cursor = cursors[page]
+        version = view.version()
+        rows = await self._cached((view.name, version, json.dumps(cursor)), lambda: view.load_page(query.get_bot(), cursor))
+        total = await self._cached((view.name, version, "count"), lambda: db.run(view.count_rows))
+
+        text, shown = view.render(rows, total, page)
+        del cursors[page + 1:]
+        if shown < len(rows):
+            cursors.append(view.cursor_of(rows[shown - 1]))
+        all_cursors[view.name] = cursors
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️ السابق", callback_data=f"list_{view.name}_{page - 1}"))
+        if shown < len(rows):
+            navigation.append(InlineKeyboardButton("التالي ▶️", callback_data=f"list_{view.name}_{page + 1}"))
+        keyboard = [navigation] if navigation else []
+        keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data=view.back)])
+        try:
+            await query.edit_message_text(
+                text,
+                parse_mode=ParseMode.MARKDOWN_V2 if view.markdown else None,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+            )
+        except BadRequest as e:
+            logger.warning(f"تعذر عرض القائمة {view.name}: {e}")
+
+async def _fill_blocked_names(bot, rows):
+    """
+    يجلب أسماء المحظورين الظاهرين في الصفحة ممن سجلهم البث بلا اسم، ويحفظها حتى لا تُجلب مرة أخرى.
+    الرفض النهائي (BadRequest/Forbidden) يُحفظ كـ "غير معروف"، أما الأخطاء المؤقتة فتبقى فارغة لتُعاد لاحقًا.
+    """
+    missing = [row[0] for row in rows[:ADMIN_LIST_PAGE_SIZE] if row[1] is None]
+    if not missing:
+        return rows
+
+    async def lookup(uid):
+        try:
+            chat = await bot.get_chat(uid)
+            return uid, chat.full_name or "غير معروف", chat.username or "غير متوفر"
+        except (BadRequest, Forbidden) as e:
+            logger.warning(f"فشل جلب معلومات المستخدم {uid}: {e}")
+            return uid, "غير معروف", "غير متوفر"
+        except TelegramError as e:
+            logger.warning(f"تعذر جلب معلومات المستخدم {uid} مؤقتًا، ستُعاد المحاولة عند العرض التالي: {e}")
+            return None
+
+    names = {info[0]: info for info in await asyncio.gather(*map(lookup, missing)) if info is not None}
+    if not names:
+        return rows
+
+    def _save_blocked_names(cur):
+        execute_values(cur, """
+            UPDATE blocked_users AS b SET full_name = v.full_name, username = v.username
+            FROM (VALUES %s) AS v (user_id, full_name, username)
+            WHERE b.user_id = v.user_id AND b.full_name IS NULL;
+        """, list(names.values()))
+
     try:
-        chat_member = await context.bot.get_chat_member(chat_id, user_id)
-        return chat_member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-    except (BadRequest, Forbidden):
-        return False
+        await db.run(_save_blocked_names)
+    except psycopg2.Error as e:
+        logger.error(f"فشل حفظ أسماء المحظورين: {e}")
+    return [names[row[0]] + tuple(row[3:]) if row[0] in names else row for row in rows]
+
+def _format_blocked_user(row) -> str:
+    uid, full_name, username, blocked_date = row
+    safe_name = escape_markdown(full_name or "غير معروف")
+    safe_username = escape_markdown(f"@{username}" if username and username != "غير متوفر" else "N/A")
+    date = escape_markdown(blocked_date.strftime('%Y-%m-%d') if blocked_date else "-")
+    return f"- *{safe_name}* ({safe_username})\n  ID: `{uid}`\n  تاريخ: {date}"
+
+admin_list_views = {
+    view.name: view for view in (
+        AdminListView(
+            "blocked", "📵 قائمة المستخدمين الذين قاموا بحظر البوت:", "لا يوجد أي مستخدمين في قائمة الحظر حاليًا.",
+            "admin_panel_main", "blocked_users", ("user_id", "full_name", "username", "blocked_date"), ("blocked_date", "user_id"),
+            _format_blocked_user, lambda: user_registry.blocked_version, descending=True, markdown=True,
+            enrich=_fill_blocked_names,
+        ),
+        AdminListView(
+            "banned", "قائمة الكلمات المحظورة:", "لا توجد كلمات محظورة.", "admin_manage_banned",
+            "banned_words", ("word", "duration_minutes"), ("word",),
+            lambda row: f"- {row[0]} ({row[1]} د)", lambda: rule_cache.snapshot.version,
+        ),
+        AdminListView(
+            "replies", "قائمة الردود التلقائية:", "لا توجد ردود تلقائية.", "admin_manage_replies",
+            "auto_replies", ("keyword",), ("keyword",),
+            lambda row: f"- {row[0]}", lambda: rule_cache.snapshot.version,
+        ),
+        AdminListView(
+            "links", "قائمة الروابط المسموحة:", "لا توجد روابط مسموحة.", "admin_manage_links",
+            "allowed_links", ("link_pattern",), ("link_pattern",),
+            lambda row: f"- {row[0]}", lambda: rule_cache.snapshot.version,
+        ),
+    )
+}
+admin_list_pager = AdminListPager(ADMIN_LIST_CACHE_TTL, ADMIN_LIST_CACHE_MAX)
+
+# --- استيراد وتصدير القواعد والمستخدمين ---
+
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_MB", "10")) * 1024 * 1024
+BULK_PAGE_SIZE = 1000
+DEFAULT_BANNED_WARNING = "⚠️ {user}، هذه الكلمة ممنوعة في المجموعة."
+
+class BulkTable:
+    """جدول يمكن تصديره واستيراده كملف CSV أو JSON؛ أول عمود هو المفتاح الأساسي."""
+
+    def __init__(self, name, table, columns, coerce, rules=False):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.coerce = coerce
+        self.rules = rules
+
+    @property
+    def key(self) -> str:
+        return self.columns[0]
+
+    def export_rows(self, cur):
+        cur.execute(f"SELECT {', '.join(self.columns)} FROM {self.table} ORDER BY {self.key};")
+        return cur.fetchall()
+
+    def upsert(self, cur, rows, replace: bool):
+        """كل الصفوف في معاملة واحدة: حذف اختياري ثم INSERT متعدد الصفوف على دفعات."""
+        if replace:
+            cur.execute(f"DELETE FROM {self.table};")
+        updates = self.columns[1:]
+        conflict = (
+            f"ON CONFLICT ({self.key}) DO UPDATE SET " + ", ".join(f"{column} = EXCLUDED.{column}" for column in updates)
+            if updates else "ON CONFLICT DO NOTHING"
+        )
+        execute_values(
+            cur, f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES %s {conflict};", rows, page_size=BULK_PAGE_SIZE,
+        )
+        if self.table == "blocked_users":
+            cur.execute("DELETE FROM users WHERE user_id = ANY(%s);", ([row[0] for row in rows],))
+
+def _text(record: dict, column: str, required: bool = True) -> str:
+    value = record.get(column)
+    if isinstance(value, (list, dict)):
+        raise ValueError(f"الحقل {column} ليس قيمة مفردة")
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"الحقل {column} فارغ")
+    return value
+
+def _user_id(record: dict) -> int:
+    try:
+        return int(str(record.get("user_id", "")).strip())
+    except ValueError:
+        raise ValueError("user_id ليس رقمًا") from None
+
+bulk_tables = {
+    table.name: table for table in (
+        BulkTable("banned", "banned_words", ("word", "duration_minutes", "warning_message"), lambda r: (
+            _text(r, "word"), int(_text(r, "duration_minutes", False) or 0), _text(r, "warning_message", False) or DEFAULT_BANNED_WARNING,
+        ), rules=True),
+        BulkTable("replies", "auto_replies", ("keyword", "reply"), lambda r: (_text(r, "keyword"), _text(r, "reply")), rules=True),
+        BulkTable("links", "allowed_links", ("link_pattern",), lambda r: (_text(r, "link_pattern"),), rules=True),
+        BulkTable("users", "users", ("user_id",), lambda r: (_user_id(r),)),
+        BulkTable("blocked", "blocked_users", ("user_id", "full_name", "username"), lambda r: (
+            _user_id(r), _text(r, "full_name", False) or "غير معروف", _text(r, "username", False) or "غير متوفر",
+        )),
+    )
+}
+
+def serialize_rows(table: BulkTable, rows, fmt: str) -> bytes:
+    if fmt == "json":
+        return json.dumps([dict(zip(table.columns, row)) for row in rows], ensure_ascii=False, indent=1).encode()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(table.columns)
+    writer.writerows(rows)
+    # BOM حتى يفتح Excel الملف بالعربية بشكل صحيح
+    return buffer.getvalue().encode("utf-8-sig")
+
+def parse_records(table: BulkTable, content: bytes, filename: str):
+    """
+    يعيد (صفوف صالحة بلا تكرار في المفتاح، أخطاء). JSON: قائمة كائنات، أو قيم مفردة لجداول العمود الواحد،
+    أو كائن يحوي هذه القائمة باسم الجدول؛ CSV: بسطر عناوين.
+    """
+    text = content.decode("utf-8-sig")
+    if filename.lower().endswith(".json") or text.lstrip()[:1] in ("[", "{"):
+        records = json.loads(text)
+        if isinstance(records, dict):
+            if table.name not in records:
+                raise ValueError(f"الملف لا يحتوي على الجدول {table.name} (الموجود: {', '.join(map(str, records)) or 'لا شيء'})")
+            records = records[table.name]
+        if not isinstance(records, list):
+            raise ValueError("يجب أن يكون محتوى JSON قائمة سجلات")
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        if reader.fieldnames and table.key not in reader.fieldnames:
+            # ملف بلا عناوين: الأعمدة بترتيب الجدول
+            reader = csv.DictReader(io.StringIO(text), fieldnames=table.columns)
+        records = list(reader)
+    rows, errors = {}, []
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            if len(table.columns) > 1 or isinstance(record, bool) or not isinstance(record, (str, int)):
+                errors.append(f"السطر {number}: سجل غير صالح {json.dumps(record, ensure_ascii=False)[:50]}")
+                continue
+            record = {table.key: record}
+        try:
+            row = table.coerce(record)
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"السطر {number}: {e}")
+            continue
+        rows[row[0]] = row
+    return list(rows.values()), errors
+
+async def apply_bulk_import(table: BulkTable, rows, replace: bool):
+    """يكتب الصفوف في معاملة واحدة ثم يعيد بناء الذاكرة المؤقتة مرة واحدة."""
+    if rows or replace:
+        await db.run(table.upsert, rows, replace)
+    if table.rules:
+        await rule_cache.invalidate()
+    elif table.name == "users" and replace:
+        user_registry.forget_known()
+        await state_backend.publish("users_replaced")
+    elif table.name == "blocked":
+        if rows:
+            blocked_ids = [row[0] for row in rows]
+            user_registry.mark_blocked(blocked_ids)
+            await state_backend.publish("users_blocked", blocked_ids)
+        if replace:
+            await user_registry.reload_blocked()
+            await state_backend.publish("blocked_replaced")
 
 # --- معالجات الأوامر والرسائل ---
 
+@timed_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    conn = get_db_connection()
-    if not conn:
+    user_registry.register(user.id, unblock=True)
+
+    try:
+        welcome_message = (await db.fetchone("SELECT value FROM settings WHERE key = 'welcome_message';"))[0]
+    except psycopg2.Error as e:
+        logger.error(f"لا يمكن الاتصال بقاعدة البيانات: {e}")
         await update.message.reply_text("عذرًا، حدث خطأ في الخدمة.")
         return
+    await update.message.reply_text(welcome_message)
+    if user.id == ADMIN_ID:
+        await send_admin_panel(update, context)
+
+@timed_handler
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member or update.my_chat_member
+    chat_id = member_update.chat.id
+    if update.my_chat_member:
+        # تغيّرت صلاحيات البوت نفسه، لذا نعيد جلب القائمة كاملة عند الحاجة
+        admin_roster_cache.invalidate(chat_id)
+        return
+    new_member = member_update.new_chat_member
+    admin_roster_cache.apply_member_update(chat_id, new_member.user.id, new_member.status)
+
+@timed_handler
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    text = (
+        f"📊 إحصائيات البوت\n\n"
+        f"مجمع الاتصالات: {db.stats}\n"
+        f"ذاكرة المشرفين: {admin_roster_cache.stats}\n"
+        f"تسجيل المستخدمين: {user_registry.stats}\n"
+        f"معالجة التحديثات: {update_processor.stats}\n"
+        f"التحميلات: {download_manager.stats} (في الطابور: {download_manager.queue_depth()})\n"
+        f"ذاكرة الوسائط: {media_cache.stats} (نسبة الإصابة: {media_cache.hit_rate():.0%})\n"
+        f"قوائم المشرف: {admin_list_pager.stats}\n"
+        f"مكافحة الإغراق: {flood_guard.stats}\n"
+        f"إصدار القواعد: {rule_cache.snapshot.version}"
+    )
+    await update.message.reply_text(text)
+
+@timed_handler
+async def purge_media_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/purge_media [رابط]: يحذف فيديو رابط معيّن من ذاكرة الوسائط، أو كل الذاكرة بدون رابط."""
+    if update.effective_user.id != ADMIN_ID: return
+    url = context.args[0] if context.args else None
+    try:
+        purged = await media_cache.purge(url)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في حذف ذاكرة الوسائط: {e}")
+        await update.message.reply_text("❌ حدث خطأ أثناء الحذف.")
+        return
+    await update.message.reply_text(f"✅ تم حذف {purged} عنصر من ذاكرة الوسائط.")
+
+@timed_handler
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export <banned|replies|links|users|blocked> [csv|json]: يرسل الجدول كملف."""
+    if update.effective_user.id != ADMIN_ID: return
+    args = context.args or []
+    table = bulk_tables.get(args[0]) if args else None
+    fmt = args[1].lower() if len(args) > 1 else "csv"
+    if table is None or fmt not in ("csv", "json"):
+        await update.message.reply_text(f"الاستخدام: /export {'|'.join(bulk_tables)} [csv|json]")
+        return
     try:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING;", (user.id,))
-            cur.execute("DELETE FROM blocked_users WHERE user_id = %s;", (user.id,))
-            
-            cur.execute("SELECT value FROM settings WHERE key = 'welcome_message';")
-            welcome_message = cur.fetchone()[0]
-        conn.commit()
-        await update.message.reply_text(welcome_message)
-        if user.id == ADMIN_ID:
-            await send_admin_panel(update, context)
-    finally:
-        if conn:
-            conn.close()
+        rows = await db.run(table.export_rows)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في تصدير {table.name}: {e}")
+        await update.message.reply_text("❌ حدث خطأ أثناء التصدير.")
+        return
+    await update.message.reply_document(
+        InputFile(serialize_rows(table, rows, fmt), filename=f"{table.name}.{fmt}"),
+        caption=f"📤 {table.name}: {len(rows)} صف.",
+    )
+
+@timed_handler
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /import <banned|replies|links|users|blocked> [replace] كتعليق على ملف CSV/JSON أو ردًا عليه.
+    الصفوف الموجودة تُحدّث والجديدة تُضاف، ومع replace يُستبدل الجدول كاملًا.
+    """
+    if update.effective_user.id != ADMIN_ID: return
+    message = update.message
+    args = (message.text or message.caption or "").split()[1:]
+    table = bulk_tables.get(args[0]) if args else None
+    replace = len(args) > 1 and args[1].lower() == "replace"
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if table is None or document is None:
+        await message.reply_text(f"الاستخدام: أرسل ملف CSV أو JSON مع التعليق /import {'|'.join(bulk_tables)} [replace]")
+        return
+    if document.file_size and document.file_size > BULK_IMPORT_MAX_BYTES:
+        await message.reply_text(f"❌ الملف أكبر من الحد المسموح ({BULK_IMPORT_MAX_BYTES // (1024 * 1024)} ميغابايت).")
+        return
 
+    try:
+        content = bytes(await (await document.get_file()).download_as_bytearray())
+        rows, errors = parse_records(table, content, document.file_name or "")
+    except (ValueError, TypeError, UnicodeDecodeError, csv.Error) as e:
+        await message.reply_text(f"❌ تعذر قراءة الملف: {e}")
+        return
+    if replace and not rows:
+        await message.reply_text("❌ لا توجد صفوف صالحة، لن يُستبدل الجدول بجدول فارغ.")
+        return
+    if replace and errors:
+        await message.reply_text(
+            f"❌ في الملف {len(errors)} صف غير صالح، لن يُستبدل الجدول:\n" + "\n".join(errors[:10])
+        )
+        return
+
+    started = time.monotonic()
+    try:
+        await apply_bulk_import(table, rows, replace)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في استيراد {table.name}: {e}")
+        await message.reply_text("❌ فشل الاستيراد ولم يُحفظ أي صف.")
+        return
+    text = f"📥 {table.name}: تم حفظ {len(rows)} صف في {time.monotonic() - started:.1f} ثانية."
+    if errors:
+        text += f"\nتم تجاهل {len(errors)} صف:\n" + "\n".join(errors[:10])
+    await message.reply_text(text)
+
+@timed_handler
 async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not (message.text or message.caption): return
@@ -155,76 +2666,40 @@ async def group_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     message_text = (message.text or message.caption).lower()
     
     user_is_admin = await is_user_group_admin(chat.id, user.id, context)
+    rules = rule_cache.snapshot
+    user_registry.register(user.id)
 
-    conn = get_db_connection()
-    if not conn: return
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING;", (user.id,))
-            conn.commit()
+    if not user_is_admin:
+        if flood_guard.is_flooding(chat.id, user.id):
+            flood_guard.punish(message, user, f"⚠️ {user.mention_html()}، تم تقييدك مؤقتًا بسبب إرسال رسائل كثيرة.", FLOOD_RESTRICT_MINUTES)
+            return
+        if not all(rules.link_policy.is_allowed(link) for link in message_links(message)):
+            flood_guard.punish(message, user, f"⚠️ {user.mention_html()}، يمنع إرسال الروابط.")
+            return
 
-            if not user_is_admin:
-                if re.search(r'https?://|t\.me/|www\.', message_text):
-                    cur.execute("SELECT link_pattern FROM allowed_links;")
-                    allowed_links = [row[0] for row in cur.fetchall()]
-                    if not any(pattern in message_text for pattern in allowed_links):
-                        try:
-                            await message.delete()
-                            await context.bot.send_message(chat.id, f"⚠️ {user.mention_html()}، يمنع إرسال الروابط.", parse_mode=ParseMode.HTML)
-                        except Exception as e: 
-                            logger.error(f"خطأ في حذف رابط: {e}")
-                        return
-
-                cur.execute("SELECT word, duration_minutes, warning_message FROM banned_words;")
-                banned_words = cur.fetchall()
-                for word, duration, warning in banned_words:
-                    if re.search(r'\b' + re.escape(word.lower()) + r'\b', message_text):
-                        try:
-                            await message.delete()
-                            final_warning = warning.replace("{user}", user.mention_html())
-                            await context.bot.send_message(chat.id, final_warning, parse_mode=ParseMode.HTML)
-                            if duration > 0:
-                                await context.bot.restrict_chat_member(
-                                    chat.id, 
-                                    user.id, 
-                                    permissions=ChatPermissions(can_send_messages=False), 
-                                    until_date=message.date + timedelta(minutes=duration)
-                                )
-                        except Exception as e: 
-                            logger.error(f"خطأ في حظر كلمة: {e}")
-                        return
-
-            cur.execute("SELECT keyword, reply FROM auto_replies;")
-            auto_replies = cur.fetchall()
-            for keyword, reply in auto_replies:
-                if keyword.lower() in message_text:
-                    await message.reply_text(reply)
-                    break
-    finally:
-        if conn:
-            conn.close()
+    banned_hit, reply = rules.matcher.match(message_text, check_banned=not user_is_admin)
+    if banned_hit:
+        word, duration, warning = banned_hit
+        flood_guard.punish(message, user, warning.replace("{user}", user.mention_html()), duration)
+        return
 
+    if reply and flood_guard.allow_reply(chat.id, user.id, reply):
+        await message.reply_text(reply)
+
+@timed_handler
 async def private_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     message = update.message
     
-    conn = get_db_connection()
-    if not conn: return
-    
-    try:
-        with conn.cursor() as cur:
-            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING;", (user.id,))
-            cur.execute("DELETE FROM blocked_users WHERE user_id = %s;", (user.id,))
-            conn.commit()
+    user_registry.register(user.id, unblock=True)
 
-            if user.id == ADMIN_ID:
-                if message.text and message.text.strip().lower() == "يمان":
-                    await send_admin_panel(update, context)
-                return
+    try:
+        if user.id == ADMIN_ID:
+            if message.text and message.text.strip().lower() == "يمان":
+                await send_admin_panel(update, context)
+            return
 
-            cur.execute("SELECT value FROM settings WHERE key = 'forward_reply_message';")
-            reply_text = cur.fetchone()[0]
+        reply_text = (await db.fetchone("SELECT value FROM settings WHERE key = 'forward_reply_message';"))[0]
         
         await message.reply_text(reply_text)
         
@@ -233,264 +2708,375 @@ async def private_message_handler(update: Update, context: ContextTypes.DEFAULT_
         await context.bot.send_message(chat_id=ADMIN_ID, text=f"👆 رسالة من {user.full_name} ({user.id})", reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logger.error(f"خطأ في معالجة الرسالة الخاصة: {e}")
-    finally:
-        if conn:
-            conn.close()
 
+@timed_handler
 async def media_downloader_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     if not message or not message.text: return
     url = message.text.strip()
     
-    processing_message = await message.reply_text("⏳ جاري معالجة الرابط...")
-    
-    download_folder = "downloads"
-    os.makedirs(download_folder, exist_ok=True)
+    if await send_cached_media(context.bot, message.chat_id, media_cache.url_key(url)):
+        return
     
-    ydl_opts = {
-        'format': 'best',
-        'outtmpl': os.path.join(download_folder, '%(id)s.%(ext)s'),
-        'quiet': True,
-        'noplaylist': True,
-        'max_filesize': 50 * 1024 * 1024, # 50MB
-    }
+    job = DownloadJob(context.bot, message.from_user.id, message.chat_id, url)
+    position = download_manager.reserve(job)
+    if position is None:
+        await message.reply_text(f"⚠️ لديك بالفعل {DOWNLOAD_PER_USER_LIMIT} تحميل قيد التنفيذ. انتظر حتى ينتهي.")
+        return
     
+    text = "⏳ جاري معالجة الرابط..." if position == 0 else f"⏳ تمت إضافة الرابط إلى الطابور. ترتيبك: {position}"
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            await context.bot.send_video(chat_id=message.chat_id, video=open(filename, 'rb'), caption=info.get('title', '✅ تم التحميل'))
-            
-            os.remove(filename)
-            await processing_message.delete()
+        job.status_message = await message.reply_text(text, reply_markup=job.cancel_markup())
+    except Exception:
+        download_manager.discard(job)
+        raise
+    download_manager.enqueue(job)
 
-    except Exception as e:
-        logger.error(f"خطأ في تحميل الفيديو باستخدام yt-dlp: {e}")
-        await processing_message.edit_text("❌ حدث خطأ أثناء التحميل. قد يكون الفيديو خاصًا، محذوفًا، أو من منصة غير مدعومة حاليًا.")
-        for f in os.listdir(download_folder):
-            try:
-                os.remove(os.path.join(download_folder, f))
-            except OSError:
-                pass
+async def save_conversation_state(user_id: int, state: dict):
+    """يحفظ حالة محادثة المشرف في الحالة المشتركة دون إسقاط المعالج عند فشل القاعدة."""
+    try:
+        await state_backend.save_conversation(user_id, state)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قاعدة البيانات أثناء حفظ حالة المحادثة: {e}")
 
+@timed_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
     
-    conn = get_db_connection()
-    if not conn: return
+    if data.startswith("download_cancel_"):
+        cancelled = await download_manager.cancel(int(data.split('_')[2]), query.from_user.id)
+        await query.answer(None if cancelled else "لا يمكن إلغاء هذا التحميل.")
+        return
+    await query.answer()
+    
+    try:
+        state = await state_backend.load_conversation(query.from_user.id)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قاعدة البيانات أثناء تحميل حالة المحادثة: {e}")
+        return
     
     try:
-        with conn.cursor() as cur:
-            if data == "admin_panel_main": await send_admin_panel(update, context)
-            elif data == "admin_broadcast":
-                await query.edit_message_text("أرسل الآن الرسالة التي تود بثها للجميع. للإلغاء أرسل /cancel.")
-                context.user_data['next_step'] = 'broadcast_message'
-            
-            elif data == "admin_blocked_list":
-                # --- تعديل: جلب وعرض معلومات المستخدم الكاملة ---
-                cur.execute("SELECT user_id, full_name, username, TO_CHAR(blocked_date, 'YYYY-MM-DD') FROM blocked_users ORDER BY blocked_date DESC;")
-                blocked_users = cur.fetchall()
-                text = "📵 *قائمة المستخدمين الذين قاموا بحظر البوت:*\n\n"
-                if blocked_users:
-                    lines = []
-                    for uid, full_name, username, date in blocked_users:
-                        safe_name = escape_markdown(full_name)
-                        safe_username = escape_markdown(f"@{username}" if username and username != "غير متوفر" else "N/A")
-                        line = f"- *{safe_name}* ({safe_username})\n  ID: `{uid}`\n  تاريخ: {date}"
-                        lines.append(line)
-                    text += "\n\n".join(lines)
-                else:
-                    text += escape_markdown("لا يوجد أي مستخدمين في قائمة الحظر حاليًا.")
-                
-                await query.edit_message_text(
-                    text, 
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]])
-                )
+        if data == "admin_panel_main": await send_admin_panel(update, context)
+        elif data == "admin_broadcast":
+            await query.edit_message_text("أرسل الآن الرسالة التي تود بثها للجميع. للإلغاء أرسل /cancel.")
+            state['next_step'] = 'broadcast_message'
+        
+        elif data == "admin_blocked_list":
+            await admin_list_pager.show(admin_list_views["blocked"], query, state, 0)
+        elif data.startswith("list_"):
+            _, name, page = data.split('_')
+            if name in admin_list_views:
+                await admin_list_pager.show(admin_list_views[name], query, state, int(page))
 
-            elif data.startswith("admin_reply_to_"):
-                user_id = data.split('_')[3]
-                context.user_data['user_to_reply'] = user_id
-                await query.edit_message_text(f"أنت الآن ترد على المستخدم {user_id}. أرسل رسالتك.")
-                context.user_data['next_step'] = 'reply_to_user_message'
-            elif data == "admin_manage_banned":
-                kb = [[InlineKeyboardButton("➕ إضافة كلمة", callback_data="banned_add")], [InlineKeyboardButton("➖ حذف كلمة", callback_data="banned_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="banned_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
-                await query.edit_message_text("🚫 إدارة الكلمات المحظورة:", reply_markup=InlineKeyboardMarkup(kb))
-            elif data == "banned_add":
-                await query.edit_message_text("أرسل الكلمة التي تريد حظرها.")
-                context.user_data['next_step'] = 'banned_add_word'
-            elif data.startswith("banned_set_duration_"):
-                parts = data.split('_')
-                word, duration = parts[3], int(parts[4])
-                context.user_data.update({'banned_word': word, 'banned_duration': duration, 'next_step': 'banned_add_warning'})
-                await query.edit_message_text(f"الكلمة: {word}\nالمدة: {duration} دقيقة.\n\nالآن أرسل رسالة التحذير.")
-            elif data == "banned_delete":
-                await query.edit_message_text("أرسل الكلمة التي تريد حذفها من الحظر.")
-                context.user_data['next_step'] = 'banned_delete_word'
-            elif data == "banned_list":
-                cur.execute("SELECT word, duration_minutes FROM banned_words;")
-                words = cur.fetchall()
-                text = "قائمة الكلمات المحظورة:\n" + "\n".join([f"- {w} ({d} د)" for w, d in words]) if words else "لا توجد كلمات محظورة."
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_manage_banned")]]))
-            elif data == "admin_manage_replies":
-                kb = [[InlineKeyboardButton("➕ إضافة رد", callback_data="reply_add")], [InlineKeyboardButton("➖ حذف رد", callback_data="reply_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="reply_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
-                await query.edit_message_text("📝 إدارة الردود التلقائية:", reply_markup=InlineKeyboardMarkup(kb))
-            elif data == "reply_add":
-                await query.edit_message_text("أرسل الكلمة المفتاحية للرد الجديد.")
-                context.user_data['next_step'] = 'reply_add_keyword'
-            elif data == "reply_delete":
-                await query.edit_message_text("أرسل الكلمة المفتاحية للرد الذي تريد حذفه.")
-                context.user_data['next_step'] = 'reply_delete_keyword'
-            elif data == "reply_list":
-                cur.execute("SELECT keyword FROM auto_replies;")
-                replies = cur.fetchall()
-                text = "قائمة الردود التلقائية:\n" + "\n".join([f"- {r[0]}" for r in replies]) if replies else "لا توجد ردود تلقائية."
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_manage_replies")]]))
-            elif data == "admin_manage_links":
-                kb = [[InlineKeyboardButton("➕ إضافة رابط", callback_data="link_add")], [InlineKeyboardButton("➖ حذف رابط", callback_data="link_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="link_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
-                await query.edit_message_text("🔗 إدارة الروابط المسموحة:", reply_markup=InlineKeyboardMarkup(kb))
-            elif data == "link_add":
-                await query.edit_message_text("أرسل جزءًا من الرابط للسماح به (مثلاً: youtube.com).")
-                context.user_data['next_step'] = 'link_add_pattern'
-            elif data == "link_delete":
-                await query.edit_message_text("أرسل جزء الرابط الذي تريد حذفه.")
-                context.user_data['next_step'] = 'link_delete_pattern'
-            elif data == "link_list":
-                cur.execute("SELECT link_pattern FROM allowed_links;")
-                links = cur.fetchall()
-                text = "قائمة الروابط المسموحة:\n" + "\n".join([f"- {l[0]}" for l in links]) if links else "لا توجد روابط مسموحة."
-                await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="admin_manage_links")]]))
-            elif data == "admin_edit_messages":
-                kb = [[InlineKeyboardButton("تعديل رسالة الترحيب", callback_data="msg_edit_welcome")], [InlineKeyboardButton("تعديل رسالة الرد على التواصل", callback_data="msg_edit_forward")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
-                await query.edit_message_text("⚙️ تعديل رسائل البوت:", reply_markup=InlineKeyboardMarkup(kb))
-            elif data == "msg_edit_welcome":
-                await query.edit_message_text("أرسل رسالة الترحيب الجديدة.")
-                context.user_data['next_step'] = 'msg_set_welcome'
-            elif data == "msg_edit_forward":
-                await query.edit_message_text("أرسل رسالة الرد التلقائي الجديدة عند التواصل مع البوت.")
-                context.user_data['next_step'] = 'msg_set_forward'
+        elif data.startswith("admin_reply_to_"):
+            user_id = data.split('_')[3]
+            state['user_to_reply'] = user_id
+            await query.edit_message_text(f"أنت الآن ترد على المستخدم {user_id}. أرسل رسالتك.")
+            state['next_step'] = 'reply_to_user_message'
+        elif data == "admin_manage_banned":
+            kb = [[InlineKeyboardButton("➕ إضافة كلمة", callback_data="banned_add")], [InlineKeyboardButton("➖ حذف كلمة", callback_data="banned_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="banned_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
+            await query.edit_message_text("🚫 إدارة الكلمات المحظورة:", reply_markup=InlineKeyboardMarkup(kb))
+        elif data == "banned_add":
+            await query.edit_message_text("أرسل الكلمة التي تريد حظرها.")
+            state['next_step'] = 'banned_add_word'
+        elif data.startswith("banned_set_duration_"):
+            parts = data.split('_')
+            word, duration = parts[3], int(parts[4])
+            state.update({'banned_word': word, 'banned_duration': duration, 'next_step': 'banned_add_warning'})
+            await query.edit_message_text(f"الكلمة: {word}\nالمدة: {duration} دقيقة.\n\nالآن أرسل رسالة التحذير.")
+        elif data == "banned_delete":
+            await query.edit_message_text("أرسل الكلمة التي تريد حذفها من الحظر.")
+            state['next_step'] = 'banned_delete_word'
+        elif data == "banned_list":
+            await admin_list_pager.show(admin_list_views["banned"], query, state, 0)
+        elif data == "admin_manage_replies":
+            kb = [[InlineKeyboardButton("➕ إضافة رد", callback_data="reply_add")], [InlineKeyboardButton("➖ حذف رد", callback_data="reply_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="reply_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
+            await query.edit_message_text("📝 إدارة الردود التلقائية:", reply_markup=InlineKeyboardMarkup(kb))
+        elif data == "reply_add":
+            await query.edit_message_text("أرسل الكلمة المفتاحية للرد الجديد.")
+            state['next_step'] = 'reply_add_keyword'
+        elif data == "reply_delete":
+            await query.edit_message_text("أرسل الكلمة المفتاحية للرد الذي تريد حذفه.")
+            state['next_step'] = 'reply_delete_keyword'
+        elif data == "reply_list":
+            await admin_list_pager.show(admin_list_views["replies"], query, state, 0)
+        elif data == "admin_manage_links":
+            kb = [[InlineKeyboardButton("➕ إضافة رابط", callback_data="link_add")], [InlineKeyboardButton("➖ حذف رابط", callback_data="link_delete")], [InlineKeyboardButton("📋 عرض الكل", callback_data="link_list")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
+            await query.edit_message_text("🔗 إدارة الروابط المسموحة:", reply_markup=InlineKeyboardMarkup(kb))
+        elif data == "link_add":
+            await query.edit_message_text("أرسل جزءًا من الرابط للسماح به (مثلاً: youtube.com).")
+            state['next_step'] = 'link_add_pattern'
+        elif data == "link_delete":
+            await query.edit_message_text("أرسل جزء الرابط الذي تريد حذفه.")
+            state['next_step'] = 'link_delete_pattern'
+        elif data == "link_list":
+            await admin_list_pager.show(admin_list_views["links"], query, state, 0)
+        elif data == "admin_edit_messages":
+            kb = [[InlineKeyboardButton("تعديل رسالة الترحيب", callback_data="msg_edit_welcome")], [InlineKeyboardButton("تعديل رسالة الرد على التواصل", callback_data="msg_edit_forward")], [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel_main")]]
+            await query.edit_message_text("⚙️ تعديل رسائل البوت:", reply_markup=InlineKeyboardMarkup(kb))
+        elif data == "msg_edit_welcome":
+            await query.edit_message_text("أرسل رسالة الترحيب الجديدة.")
+            state['next_step'] = 'msg_set_welcome'
+        elif data == "msg_edit_forward":
+            await query.edit_message_text("أرسل رسالة الرد التلقائي الجديدة عند التواصل مع البوت.")
+            state['next_step'] = 'msg_set_forward'
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قاعدة البيانات أثناء معالجة الزر {data}: {e}")
     finally:
-        if conn:
-            conn.close()
+        await save_conversation_state(query.from_user.id, state)
 
+@timed_handler
 async def conversation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID or 'next_step' not in context.user_data: return
-    step = context.user_data.pop('next_step', None)
+    if update.effective_user.id != ADMIN_ID: return
+    try:
+        state = await state_backend.load_conversation(ADMIN_ID)
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قاعدة البيانات أثناء تحميل حالة المحادثة: {e}")
+        return
+    if 'next_step' not in state: return
+    step = state.pop('next_step', None)
     message = update.message
     if message.text and message.text == '/cancel':
+        await save_conversation_state(ADMIN_ID, {})
         await message.reply_text("تم الإلغاء."); return
     
-    conn = get_db_connection()
-    if not conn: return
-    
     try:
-        with conn.cursor() as cur:
-            if step == 'broadcast_message':
-                await message.reply_text("⏳ جاري بدء البث...")
-                cur.execute("SELECT user_id FROM users;")
-                users = [r[0] for r in cur.fetchall()]
-                s, f = 0, 0
-                
-                text = message.text or message.caption
-                entities = message.entities or message.caption_entities
-                photo = message.photo[-1].file_id if message.photo else None
-                video = message.video.file_id if message.video else None
-                
-                for uid in users:
-                    try:
-                        if photo:
-                            await context.bot.send_photo(uid, photo, caption=text, caption_entities=entities)
-                        elif video:
-                            await context.bot.send_video(uid, video, caption=text, caption_entities=entities)
-                        elif text:
-                            await context.bot.send_message(uid, text, entities=entities)
-                        s += 1
-                        await asyncio.sleep(0.05)
-                    except Forbidden:
-                        logger.warning(f"المستخدم {uid} حظر البوت. سيتم نقله إلى قائمة الحظر.")
-                        # --- تعديل: جلب وتخزين معلومات المستخدم ---
-                        try:
-                            user_info = await context.bot.get_chat(uid)
-                            full_name = user_info.full_name
-                            username = user_info.username or "غير متوفر"
-                        except Exception as e:
-                            logger.error(f"فشل جلب معلومات المستخدم {uid}: {e}")
-                            full_name = "غير معروف"
-                            username = "غير معروف"
-
-                        cur.execute("""
-                            INSERT INTO blocked_users (user_id, full_name, username) 
-                            VALUES (%s, %s, %s) 
-                            ON CONFLICT (user_id) DO UPDATE SET 
-                                full_name = EXCLUDED.full_name, 
-                                username = EXCLUDED.username,
-                                blocked_date = NOW();
-                        """, (uid, full_name, username))
-                        cur.execute("DELETE FROM users WHERE user_id = %s;", (uid,))
-                        conn.commit()
-                        f += 1
-                    except Exception as e:
-                        logger.error(f"فشل البث للمستخدم {uid}: {e}")
-                        f += 1
-                await message.reply_text(f"✅ انتهى البث!\nنجح: {s}, فشل: {f}")
-
-            elif step == 'reply_to_user_message':
-                uid = context.user_data.pop('user_to_reply')
-                try: 
-                    await context.bot.copy_message(uid, ADMIN_ID, message.message_id)
-                    await message.reply_text("✅ تم إرسال ردك بنجاح.")
-                except Exception as e: 
-                    await message.reply_text(f"❌ فشل إرسال الرد: {e}")
-            elif step == 'banned_add_word':
-                word = message.text.strip()
-                kb = [[InlineKeyboardButton("حذف فقط", callback_data=f"banned_set_duration_{word}_0"), InlineKeyboardButton("ساعة", callback_data=f"banned_set_duration_{word}_60")], [InlineKeyboardButton("يوم", callback_data=f"banned_set_duration_{word}_1440"), InlineKeyboardButton("شهر", callback_data=f"banned_set_duration_{word}_43200")], [InlineKeyboardButton("سنة", callback_data=f"banned_set_duration_{word}_525600")]]
-                await message.reply_text(f"اختر مدة التقييد للكلمة: {word}", reply_markup=InlineKeyboardMarkup(kb))
-            elif step == 'banned_add_warning':
-                word, dur, warn = context.user_data.pop('banned_word'), context.user_data.pop('banned_duration'), message.text
-                cur.execute("INSERT INTO banned_words (word, duration_minutes, warning_message) VALUES (%s, %s, %s) ON CONFLICT (word) DO UPDATE SET duration_minutes = EXCLUDED.duration_minutes, warning_message = EXCLUDED.warning_message;", (word, dur, warn))
-                await message.reply_text(f"✅ تم حفظ الكلمة المحظورة: {word}.")
-            elif step == 'banned_delete_word':
-                word = message.text.strip()
-                cur.execute("DELETE FROM banned_words WHERE word = %s;", (word,));
-                await message.reply_text(f"✅ تم حذف {word}." if cur.rowcount > 0 else f"لم أجد {word}.")
-            elif step == 'reply_add_keyword':
-                context.user_data['keyword'] = message.text.strip(); context.user_data['next_step'] = 'reply_add_text'
-                await message.reply_text("الآن أرسل نص الرد.")
-            elif step == 'reply_add_text':
-                keyword, reply = context.user_data.pop('keyword'), message.text
-                cur.execute("INSERT INTO auto_replies (keyword, reply) VALUES (%s, %s) ON CONFLICT (keyword) DO UPDATE SET reply = EXCLUDED.reply;", (keyword, reply))
-                await message.reply_text("✅ تم حفظ الرد التلقائي.")
-            elif step == 'reply_delete_keyword':
-                keyword = message.text.strip()
-                cur.execute("DELETE FROM auto_replies WHERE keyword = %s;", (keyword,));
-                await message.reply_text(f"✅ تم حذف الرد {keyword}." if cur.rowcount > 0 else f"لم أجد الرد {keyword}.")
-            elif step == 'link_add_pattern':
-                pattern = message.text.strip()
-                cur.execute("INSERT INTO allowed_links (link_pattern) VALUES (%s) ON CONFLICT DO NOTHING;", (pattern,))
-                await message.reply_text(f"✅ تم إضافة النمط {pattern} للقائمة البيضاء.")
-            elif step == 'link_delete_pattern':
-                pattern = message.text.strip()
-                cur.execute("DELETE FROM allowed_links WHERE link_pattern = %s;", (pattern,));
-                await message.reply_text(f"✅ تم حذف {pattern}." if cur.rowcount > 0 else f"لم أجد {pattern}.")
-            elif step == 'msg_set_welcome':
-                cur.execute("UPDATE settings SET value = %s WHERE key = 'welcome_message';", (message.text,))
-                await message.reply_text("✅ تم تحديث رسالة الترحيب.")
-            elif step == 'msg_set_forward':
-                cur.execute("UPDATE settings SET value = %s WHERE key = 'forward_reply_message';", (message.text,))
-                await message.reply_text("✅ تم تحديث رسالة الرد على التواصل.")
-        conn.commit()
+        if step == 'broadcast_message':
+            job_id = await create_broadcast_job(message)
+            if job_id is None:
+                await message.reply_text("❌ لا يمكن بث هذا النوع من الرسائل. أرسل نصًا أو صورة أو فيديو.")
+            else:
+                await message.reply_text(f"⏳ تم إنشاء البث رقم {job_id} وسيعمل في الخلفية.")
+                await start_broadcast(context.application, job_id)
+
+        elif step == 'reply_to_user_message':
+            uid = state.pop('user_to_reply')
+            try: 
+                await context.bot.copy_message(uid, ADMIN_ID, message.message_id)
+                await message.reply_text("✅ تم إرسال ردك بنجاح.")
+            except Exception as e: 
+                await message.reply_text(f"❌ فشل إرسال الرد: {e}")
+        elif step == 'banned_add_word':
+            word = message.text.strip()
+            kb = [[InlineKeyboardButton("حذف فقط", callback_data=f"banned_set_duration_{word}_0"), InlineKeyboardButton("ساعة", callback_data=f"banned_set_duration_{word}_60")], [InlineKeyboardButton("يوم", callback_data=f"banned_set_duration_{word}_1440"), InlineKeyboardButton("شهر", callback_data=f"banned_set_duration_{word}_43200")], [InlineKeyboardButton("سنة", callback_data=f"banned_set_duration_{word}_525600")]]
+            await message.reply_text(f"اختر مدة التقييد للكلمة: {word}", reply_markup=InlineKeyboardMarkup(kb))
+        elif step == 'banned_add_warning':
+            word, dur, warn = state.pop('banned_word'), state.pop('banned_duration'), message.text
+            await db.execute("INSERT INTO banned_words (word, duration_minutes, warning_message) VALUES (%s, %s, %s) ON CONFLICT (word) DO UPDATE SET duration_minutes = EXCLUDED.duration_minutes, warning_message = EXCLUDED.warning_message;", (word, dur, warn))
+            await rule_cache.invalidate()
+            await message.reply_text(f"✅ تم حفظ الكلمة المحظورة: {word}.")
+        elif step == 'banned_delete_word':
+            word = message.text.strip()
+            deleted = await db.execute("DELETE FROM banned_words WHERE word = %s;", (word,))
+            if deleted > 0: await rule_cache.invalidate()
+            await message.reply_text(f"✅ تم حذف {word}." if deleted > 0 else f"لم أجد {word}.")
+        elif step == 'reply_add_keyword':
+            state['keyword'] = message.text.strip(); state['next_step'] = 'reply_add_text'
+            await message.reply_text("الآن أرسل نص الرد.")
+        elif step == 'reply_add_text':
+            keyword, reply = state.pop('keyword'), message.text
+            await db.execute("INSERT INTO auto_replies (keyword, reply) VALUES (%s, %s) ON CONFLICT (keyword) DO UPDATE SET reply = EXCLUDED.reply;", (keyword, reply))
+            await rule_cache.invalidate()
+            await message.reply_text("✅ تم حفظ الرد التلقائي.")
+        elif step == 'reply_delete_keyword':
+            keyword = message.text.strip()
+            deleted = await db.execute("DELETE FROM auto_replies WHERE keyword = %s;", (keyword,))
+            if deleted > 0: await rule_cache.invalidate()
+            await message.reply_text(f"✅ تم حذف الرد {keyword}." if deleted > 0 else f"لم أجد الرد {keyword}.")
+        elif step == 'link_add_pattern':
+            pattern = message.text.strip()
+            await db.execute("INSERT INTO allowed_links (link_pattern) VALUES (%s) ON CONFLICT DO NOTHING;", (pattern,))
+            await rule_cache.invalidate()
+            await message.reply_text(f"✅ تم إضافة النمط {pattern} للقائمة البيضاء.")
+        elif step == 'link_delete_pattern':
+            pattern = message.text.strip()
+            deleted = await db.execute("DELETE FROM allowed_links WHERE link_pattern = %s;", (pattern,))
+            if deleted > 0: await rule_cache.invalidate()
+            await message.reply_text(f"✅ تم حذف {pattern}." if deleted > 0 else f"لم أجد {pattern}.")
+        elif step == 'msg_set_welcome':
+            await db.execute("UPDATE settings SET value = %s WHERE key = 'welcome_message';", (message.text,))
+            await message.reply_text("✅ تم تحديث رسالة الترحيب.")
+        elif step == 'msg_set_forward':
+            await db.execute("UPDATE settings SET value = %s WHERE key = 'forward_reply_message';", (message.text,))
+            await message.reply_text("✅ تم تحديث رسالة الرد على التواصل.")
+    except psycopg2.Error as e:
+        logger.error(f"خطأ في قاعدة البيانات أثناء تنفيذ خطوة المشرف {step}: {e}")
     finally:
-        if conn:
-            conn.close()
+        await save_conversation_state(ADMIN_ID, state)
 
-def main():
-    setup_database()
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    
+# --- استقبال التحديثات ---
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# بدون رمز صريح يُشتق من رمز البوت، فتتفق عليه كل النسخ خلف الـ webhook نفسه
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or hmac.new(
+    (TELEGRAM_TOKEN or "").encode(), b"webhook-secret-token", hashlib.sha256
+).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    يعالج تحديثات الدردشات المختلفة بالتوازي، مع الحفاظ على ترتيب تحديثات الدردشة الواحدة.
+    حالة محادثة المشرف (next_step) تأتي كلها من دردشته الخاصة، فهي مرتبة بنفس القفل.
+    الحد الأعلى UPDATE_CONCURRENCY يُطبّق بعد قفل الدردشة، حتى لا تحجز دردشة واحدة
+    كثيرة الرسائل كل الأماكن وهي تنتظر دورها.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int):
+        super().__init__(max_pending)
+        self.concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        self._chat_locks = {}
+        self.stats = {"processed": 0, "waiting": 0, "running": 0, "max_waiting": 0}
+
+    @staticmethod
+    def _ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    def _chat_lock(self, key):
+        lock, users = self._chat_locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chat_locks[key] = (lock, users + 1)
+        return lock
+
+    def _release_chat_lock(self, key):
+        lock, users = self._chat_locks[key]
+        if users <= 1:
+            del self._chat_locks[key]
+        else:
+            self._chat_locks[key] = (lock, users - 1)
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        lock = self._chat_lock(key) if key is not None else contextlib.nullcontext()
+        self.stats["waiting"] += 1
+        self.stats["max_waiting"] = max(self.stats["max_waiting"], self.stats["waiting"])
+        started = False
+        try:
+            async with lock:
+                async with self._running:
+                    self.stats["waiting"] -= 1
+                    self.stats["running"] += 1
+                    started = True
+                    try:
+                        await coroutine
+                        startup_report.first_update()
+                    finally:
+                        self.stats["running"] -= 1
+                        self.stats["processed"] += 1
+        finally:
+            if not started:
+                self.stats["waiting"] -= 1
+            if key is not None:
+                self._release_chat_lock(key)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+metrics.callback(
+    "bot_update_processor", "حالة معالج التحديثات المتزامن (waiting/running/max_waiting).", "gauge",
+    lambda: {key: value for key, value in update_processor.stats.items() if key != "processed"}, "stat",
+)
+metrics.callback("bot_updates_processed_total", "التحديثات التي عالجها معالج التحديثات المتزامن.", "counter", lambda: update_processor.stats["processed"])
+
+telegram_request_seconds = metrics.histogram("bot_telegram_request_duration_seconds", "زمن كل استدعاء لواجهة تيليجرام حسب الدالة.", ("method",))
+telegram_errors = metrics.counter("bot_telegram_errors_total", "أخطاء واجهة تيليجرام حسب الدالة ونوع الخطأ.", ("method", "error"))
+telegram_retry_after = metrics.counter("bot_telegram_retry_after_total", "ردود RetryAfter (تجاوز حد الإرسال) حسب الدالة.", ("method",))
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest يسجل زمن كل استدعاء لواجهة تيليجرام ونتيجته في المقاييس."""
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            telegram_errors.inc(method, type(e).__name__)
+            if isinstance(e, RetryAfter):
+                telegram_retry_after.inc(method)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method)
+
+def allowed_updates_for(application: Application) -> list:
+    """يستنتج أنواع التحديثات من المعالجات المسجلة فقط، حتى لا يُرسل تيليجرام ما لا نعالجه."""
+    update_types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, (CommandHandler, MessageHandler)):
+                update_types.add(UpdateType.MESSAGE)
+            elif isinstance(handler, CallbackQueryHandler):
+                update_types.add(UpdateType.CALLBACK_QUERY)
+            elif isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    update_types.add(UpdateType.CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    update_types.add(UpdateType.MY_CHAT_MEMBER)
+            else:
+                logger.warning(f"نوع معالج غير معروف ({type(handler).__name__})، سيتم استقبال كل التحديثات.")
+                return Update.ALL_TYPES
+    return sorted(update_types)
+
+background_tasks = []
+
+async def post_init(application: Application):
+    startup_report.mark("telegram_init")
+    rule_cache.subscribe()
+    user_registry.subscribe()
+    await state_backend.start()
+    await rule_cache.load()
+    await user_registry.start()
+    background_tasks.append(asyncio.create_task(supervise_broadcasts(application)))
+    download_manager.start()
+    flood_guard.start(application.bot)
+    if METRICS_PORT:
+        try:
+            await metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"تعذر تشغيل نقطة المقاييس على المنفذ {METRICS_PORT}: {e}")
+    startup_report.ready()
+
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await stop_broadcasts()
+    await flood_guard.stop()
+    await download_manager.stop()
+    await user_registry.stop()
+    await state_backend.stop()
+    await metrics.stop_server()
+    db.close()
+
+def register_handlers(application: Application):
     application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("purge_media", purge_media_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & filters.User(ADMIN_ID) & filters.Document.ALL & filters.CaptionRegex(r'^/import(\s|$)'),
+        import_command,
+    ))
+    application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.ANY_CHAT_MEMBER))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.User(ADMIN_ID), conversation_handler), group=-1)
     
@@ -502,9 +3088,36 @@ def main():
     
     application.add_handler(MessageHandler(filters.ChatType.GROUPS & (filters.TEXT | filters.CAPTION) & ~filters.COMMAND, group_message_handler), group=2)
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, private_message_handler), group=3)
+
+def main():
+    startup_report.mark("imports")
+    try:
+        db.open()
+    except psycopg2.Error as e:
+        logger.critical(f"لا يمكن الاتصال بقاعدة البيانات: {e}")
+        exit()
+    startup_report.mark("db_connect")
+    setup_database()
+    startup_report.mark("migrations")
+    application = Application.builder().token(TELEGRAM_TOKEN).request(MeteredRequest()).concurrent_updates(update_processor).post_init(post_init).post_shutdown(post_shutdown).build()
+    register_handlers(application)
+    startup_report.mark("build")
     
-    logger.info("البوت قيد التشغيل...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    allowed_updates = allowed_updates_for(application)
+    if WEBHOOK_URL:
+        logger.info(f"البوت قيد التشغيل عبر webhook على المنفذ {WEBHOOK_PORT}... التحديثات: {allowed_updates}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        logger.info(f"البوت قيد التشغيل... التحديثات: {allowed_updates}")
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == "__main__":
     main()